@@ -1,16 +1,371 @@
-import google.generativeai as genai
-from typing import Dict, List
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+import json
 import os
+import re
+import sqlite3
+import threading
+import time
+import asyncio
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from instrumentation import span
+from query_parser import CONFIDENCE_THRESHOLD, parse_model_output, parse_query
 
 load_dotenv()
 
-# Configure the Gemini API
-genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+GEMINI_MODEL_NAME = 'gemini-pro'
+
+def load_gemini_model(name: str = GEMINI_MODEL_NAME):
+    """Import and configure the Gemini SDK, which takes most of the app's import time"""
+    import google.generativeai as genai
+
+    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+    return genai.GenerativeModel(name)
+
+class QueryCache:
+    """LRU cache of query interpretations with a time-to-live.
+
+    Keys are the normalised query text, so "Programming books?" and
+    "programming   books" share an entry.  When `db_path` is given, entries
+    are also written to a SQLite table so they survive restarts and are
+    shared between worker processes.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, db_path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = Counter(hits=0, misses=0, disk_hits=0, expired=0, evictions=0)
+        if db_path:
+            with self._connection() as conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS query_cache ('
+                    'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+                )
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Fold case, punctuation and whitespace"""
+        return ' '.join(re.sub(r'[^\w\s-]', ' ', (query or '').lower()).split())
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, query: str) -> Optional[Dict]:
+        key = self.normalize(query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return dict(value)
+                del self._entries[key]
+                self._stats['expired'] += 1
+
+        if self.db_path:
+            try:
+                row = self._connection().execute(
+                    'SELECT value, expires_at FROM query_cache WHERE key = ? AND expires_at > ?',
+                    (key, now)
+                ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Error reading query cache: {str(e)}")
+                row = None
+            if row:
+                value = json.loads(row[0])
+                with self._lock:
+                    self._stats['disk_hits'] += 1
+                    self._store(key, value, row[1])
+                return dict(value)
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def set(self, query: str, value: Dict):
+        key = self.normalize(query)
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, dict(value), expires_at)
+
+        if self.db_path:
+            try:
+                with self._connection() as conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO query_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                        (key, json.dumps(value), expires_at)
+                    )
+                    conn.execute('DELETE FROM query_cache WHERE expires_at <= ?', (time.time(),))
+            except sqlite3.Error as e:
+                print(f"Error writing query cache: {str(e)}")
+
+    def _store(self, key: str, value: Dict, expires_at: float):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.db_path:
+            with self._connection() as conn:
+                conn.execute('DELETE FROM query_cache')
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    @classmethod
+    def from_env(cls) -> 'QueryCache':
+        return cls(
+            max_size=int(os.getenv('QUERY_CACHE_SIZE', 1024)),
+            ttl=float(os.getenv('QUERY_CACHE_TTL', 3600)),
+            db_path=os.getenv('QUERY_CACHE_PATH') or None
+        )
+
+class ModelUnavailable(Exception):
+    """Raised instead of calling the model when it is known to be unhealthy or overloaded"""
+
+
+class CircuitBreaker:
+    """Stops calls to a failing dependency for a while.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls are rejected for `reset_timeout` seconds; then a single trial call
+    is let through, and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def release_trial(self):
+        with self._lock:
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_progress or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+class ModelClient:
+    """Wraps a generative model with deadlines, a concurrency limit and a circuit breaker.
+
+    `model` is anything with generate_content(prompt) and optionally
+    generate_content_async(prompt, stream=...), so a local fake can stand in
+    for Gemini.  Instead of a model, a `model_factory` can be given; it is
+    called on first use.  Calls that cannot be made (circuit open, too many
+    in flight) raise ModelUnavailable without waiting on the upstream.
+
+    A model without an async API is called on a worker thread, which cannot
+    be cancelled when the deadline passes; it keeps its in-flight slot until
+    the call returns, so at most `max_in_flight` threads are ever tied up.
+    """
+
+    def __init__(self, model=None, timeout: float = 10.0, max_in_flight: int = 16,
+                 breaker: Optional[CircuitBreaker] = None, max_workers: int = 8,
+                 model_factory: Optional[Callable] = None):
+        self._model = model
+        self._model_factory = model_factory
+        self._model_lock = threading.Lock()
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.breaker = breaker or CircuitBreaker()
+        # Only used when the model has no native async API
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gemini')
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._stats = Counter(calls=0, successes=0, failures=0, timeouts=0, rejected=0)
+        self._latencies = deque(maxlen=1000)
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._model_factory()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    @classmethod
+    def from_env(cls, model=None, model_factory: Optional[Callable] = None) -> 'ModelClient':
+        return cls(
+            model,
+            model_factory=model_factory,
+            timeout=float(os.getenv('MODEL_TIMEOUT', 10)),
+            max_in_flight=int(os.getenv('MODEL_MAX_IN_FLIGHT', 16)),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv('MODEL_FAILURE_THRESHOLD', 5)),
+                reset_timeout=float(os.getenv('MODEL_RESET_TIMEOUT', 30))
+            ),
+            max_workers=int(os.getenv('MODEL_MAX_WORKERS', 8))
+        )
+
+    def _acquire(self):
+        with self._lock:
+            self._stats['calls'] += 1
+            if self._in_flight >= self.max_in_flight:
+                self._stats['rejected'] += 1
+                raise ModelUnavailable('too many model calls in flight')
+            if not self.breaker.allow():
+                self._stats['rejected'] += 1
+                raise ModelUnavailable('model circuit is open')
+            self._in_flight += 1
+
+    def _release(self, started: float, error: Optional[BaseException], free_slot: bool = True):
+        elapsed = time.perf_counter() - started
+        # A caller going away says nothing about the model's health
+        abandoned = isinstance(error, (asyncio.CancelledError, GeneratorExit))
+        with self._lock:
+            if free_slot:
+                self._in_flight -= 1
+            if error is None:
+                self._stats['successes'] += 1
+                self._latencies.append(elapsed)
+            elif not abandoned:
+                self._stats['failures'] += 1
+                if isinstance(error, asyncio.TimeoutError):
+                    self._stats['timeouts'] += 1
+        if error is None:
+            self.breaker.record_success()
+        elif abandoned:
+            self.breaker.release_trial()
+        else:
+            self.breaker.record_failure()
+
+    def _free_slot(self, future=None):
+        with self._lock:
+            self._in_flight -= 1
+
+    async def generate(self, prompt: str):
+        """Call the model and return its response, within the deadline"""
+        self._acquire()
+        started = time.perf_counter()
+        error = None
+        future = None
+        try:
+            generate_async = getattr(self.model, 'generate_content_async', None)
+            if generate_async is not None:
+                call = generate_async(prompt)
+            else:
+                future = self._executor.submit(self.model.generate_content, prompt)
+                call = asyncio.wrap_future(future)
+            return await asyncio.wait_for(call, self.timeout)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._release(started, error, free_slot=future is None)
+            if future is not None:
+                # Runs now if the thread has finished, otherwise when it does
+                future.add_done_callback(self._free_slot)
+
+    async def generate_stream(self, prompt: str) -> AsyncIterator[str]:
+        """Yield the model's text as it is generated; the deadline covers the whole stream"""
+        generate_async = getattr(self.model, 'generate_content_async', None)
+        if generate_async is None:
+            result = await self.generate(prompt)
+            yield result.text
+            return
+
+        self._acquire()
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        error = None
+        try:
+            result = await asyncio.wait_for(generate_async(prompt, stream=True), self.timeout)
+            chunks = result.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    yield chunk.text
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._release(started, error)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = self._in_flight
+            latencies = sorted(self._latencies)
+        completed = stats['successes'] + stats['failures']
+        stats['failure_rate'] = stats['failures'] / completed if completed else 0.0
+        stats['circuit'] = self.breaker.state
+        if latencies:
+            stats['latency_p50_ms'] = latencies[len(latencies) // 2] * 1000
+            stats['latency_p95_ms'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        return stats
 
 class GeminiLibraryAgent:
-    def __init__(self):
-        self.model = genai.GenerativeModel('gemini-pro')
+    def __init__(self, confidence_threshold: float = CONFIDENCE_THRESHOLD, cache: Optional[QueryCache] = None,
+                 client: Optional[ModelClient] = None):
+        self.client = client or ModelClient.from_env(model_factory=load_gemini_model)
+        self.confidence_threshold = confidence_threshold
+        self.cache = cache if cache is not None else QueryCache.from_env()
+        self._stats = Counter(fast_path=0, cache_hits=0, model_calls=0, model_errors=0, model_skipped=0,
+                              model_seconds=0.0)
+        self._stats_lock = threading.Lock()
         self.context = """
         You are a library assistant. Your task is to help users find books and understand their queries.
         Extract the following information from user queries:
@@ -23,65 +378,118 @@ class GeminiLibraryAgent:
         Format your response as a JSON-like structure with these fields.
         """
 
+    @property
+    def model(self):
+        return self.client.model
+
+    @model.setter
+    def model(self, model):
+        self.client.model = model
+
     async def process_query(self, query: str) -> Dict:
+        # Queries the local parser understands never reach the model
+        parsed, confidence = parse_query(query)
+        if confidence >= self.confidence_threshold:
+            self._record('fast_path')
+            return parsed
+
+        cached = self.cache.get(query)
+        if cached is not None:
+            self._record('cache_hits')
+            return cached
+
         try:
-            # Default response structure
-            response = {
-                'intent': 'search',
-                'title': None,
-                'author': None,
-                'category': None,
-                'search_term': None
-            }
-            
             # Process with Gemini
             prompt = f"{self.context}\nAnalyze this query: {query}"
-            result = self.model.generate_content(prompt)
+            start = time.perf_counter()
+            with span('model'):
+                result = await self.client.generate(prompt)
+            self._record('model_calls', time.perf_counter() - start)
             
             # Extract information from Gemini's response
-            if result.text:
-                if "borrow" in query.lower():
-                    response['intent'] = 'borrow'
-                elif "return" in query.lower():
-                    response['intent'] = 'return'
-                elif "available" in query.lower():
-                    response['intent'] = 'availability'
-                
-                # Look for title in quotes
-                if '"' in query:
-                    parts = query.split('"')
-                    if len(parts) >= 3:
-                        response['title'] = parts[1]
-                
-                # Look for author after "by"
-                if 'by' in query.lower():
-                    parts = query.lower().split('by')
-                    if len(parts) >= 2:
-                        response['author'] = parts[1].strip()
-                
-                # Check for common categories
-                categories = ['fiction', 'non-fiction', 'programming', 'science', 'history']
-                for category in categories:
-                    if category in query.lower():
-                        response['category'] = category
-                        break
-                
-                # If no specific fields found, use as general search term
-                if not any([response['title'], response['author'], response['category']]):
-                    response['search_term'] = query
-            
+            response = parse_model_output(result.text, parsed)
+            self.cache.set(query, response)
             return response
             
+        except ModelUnavailable:
+            # Upstream is unhealthy or saturated; answer from the local parse
+            self._record('model_skipped')
+            return parsed
+        except Exception as e:
+            self._record('model_errors')
+            print(f"Error processing query with Gemini: {e!r}")
+            # Fallback to the local parse
+            return parsed
+
+    async def stream_query(self, query: str) -> AsyncIterator[Tuple[str, object]]:
+        """Interpret a query, yielding progress as it becomes available.
+
+        Yields ('local', parse) straight away when the model will be asked,
+        then ('model_text', chunk) for each piece of model output, and
+        always ends with ('final', interpretation).
+        """
+        parsed, confidence = parse_query(query)
+        if confidence >= self.confidence_threshold:
+            self._record('fast_path')
+            yield 'final', parsed
+            return
+
+        cached = self.cache.get(query)
+        if cached is not None:
+            self._record('cache_hits')
+            yield 'final', cached
+            return
+
+        yield 'local', dict(parsed)
+        try:
+            prompt = f"{self.context}\nAnalyze this query: {query}"
+            start = time.perf_counter()
+            text = []
+            async for chunk in self.client.generate_stream(prompt):
+                text.append(chunk)
+                yield 'model_text', chunk
+            self._record('model_calls', time.perf_counter() - start)
+            response = parse_model_output(''.join(text), parsed)
+            self.cache.set(query, response)
+        except ModelUnavailable:
+            self._record('model_skipped')
+            response = parsed
         except Exception as e:
-            print(f"Error processing query with Gemini: {str(e)}")
-            # Fallback to basic processing
-            return {
-                'intent': 'search',
-                'title': None,
-                'author': None,
-                'category': None,
-                'search_term': query
-            }
+            self._record('model_errors')
+            print(f"Error processing query with Gemini: {e!r}")
+            response = parsed
+        yield 'final', response
+
+    async def process_queries(self, queries: List[str], concurrency: int = 8) -> List[Dict]:
+        """Interpret several queries concurrently, with at most `concurrency` in flight"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def interpret(query):
+            async with semaphore:
+                return await self.process_query(query)
+
+        return list(await asyncio.gather(*(interpret(query) for query in queries)))
+
+    def _record(self, counter: str, model_latency: float = None):
+        with self._stats_lock:
+            self._stats[counter] += 1
+            if model_latency is not None:
+                self._stats['model_seconds'] += model_latency
+
+    def get_stats(self) -> Dict:
+        """Fast-path hit rate and the model latency it avoided"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        total = (stats['fast_path'] + stats['cache_hits'] + stats['model_calls']
+                 + stats['model_errors'] + stats['model_skipped'])
+        avg_latency = stats['model_seconds'] / stats['model_calls'] if stats['model_calls'] else 0.0
+        stats['queries'] = total
+        stats['fast_path_rate'] = stats['fast_path'] / total if total else 0.0
+        stats['avg_model_latency_ms'] = avg_latency * 1000
+        stats['estimated_seconds_saved'] = (stats['fast_path'] + stats['cache_hits']) * avg_latency
+        stats['cache'] = self.cache.get_stats()
+        stats['model_client'] = self.client.get_stats()
+        return stats
 
     def format_response(self, books: List[Dict], intent: str) -> str:
         if not books:
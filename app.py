@@ -1,128 +1,199 @@
-from flask import Flask, request, jsonify, render_template
-from models import db, Book, BorrowRecord
-import os
-from ai_agent import GeminiLibraryAgent
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, render_template, stream_with_context
 from dotenv import load_dotenv
-import asyncio
-from functools import wraps
-from datetime import datetime, timedelta
 
+# Load .env before the modules below read their settings from the environment
 load_dotenv()
 
-app = Flask(__name__, static_folder='static', static_url_path='/static')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///library.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+from models import db, Book, BorrowRecord, BorrowerFine, OverdueLoan
+import os
+from ai_agent import GeminiLibraryAgent, QueryCache
+from search_index import search_index
+from recommendations import recommendations
+from catalogue_cache import CATALOGUE_COLUMNS, CachedBook, catalogue_cache
+from book_ids import book_id_allocator
+from async_runtime import iterate_async, run_async
+from database import configure_database, days_between, run_with_retry
+from migrations import upgrade
+from overdue import OVERDUE_SCHEDULER, OverdueScheduler
+import instrumentation
+from instrumentation import span
+from serialization import dumps, json_response, paginated_json_response, record_serializer, row_serializer
+from datetime import datetime, timedelta
 
-db.init_app(app)
+bp = Blueprint('library', __name__)
 
-# Initialize AI agent
+# Initialize AI agent; the Gemini SDK itself is loaded on the first model call
 library_agent = GeminiLibraryAgent()
 
-def async_route(f):
-    @wraps(f)
-    def wrapped(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
-    return wrapped
+def agent_metrics():
+    """Agent counters for /metrics"""
+    stats = library_agent.get_stats()
+    for path in ('fast_path', 'cache_hits', 'model_calls', 'model_errors', 'model_skipped'):
+        yield 'library_agent_queries', {'path': path}, stats[path]
+    client = stats['model_client']
+    yield 'library_model_in_flight', {}, client['in_flight']
+    yield 'library_model_circuit_open', {}, 0 if client['circuit'] == 'closed' else 1
+    cache = catalogue_cache.get_stats()
+    for result in ('hits', 'misses', 'lookup_hits', 'lookup_misses', 'evictions', 'invalidations'):
+        yield 'library_catalogue_cache', {'result': result}, cache[result]
+    yield 'library_catalogue_cache_size', {}, cache['size']
+
+instrumentation.metrics.register_collector(agent_metrics)
+
+BOOK_FIELDS = ('book_id', 'title', 'author', 'isbn', 'available', 'quantity', 'category', 'location')
+DEFAULT_BOOK_FIELDS = ('book_id', 'title', 'author', 'available', 'quantity', 'category', 'location')
+MAX_PAGE_SIZE = 1000
+MAX_QUERY_BATCH_SIZE = 100
+QUERY_BATCH_CONCURRENCY = int(os.getenv('QUERY_BATCH_CONCURRENCY', 8))
+
+def parse_page_args(args):
+    """Return (limit, cursor) from query parameters, or raise ValueError"""
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+        cursor = int(args['cursor']) if args.get('cursor') else 0
+    except ValueError:
+        raise ValueError('limit and cursor must be integers')
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    return limit, cursor
+
+def load_books(book_ids, chunk_size=500):
+    """Load books by primary key, preserving the order of `book_ids`.
+
+    Rows come from the catalogue cache where possible; the rest are read
+    in chunks, and cached unless the result is too large to be worth it.
+    """
+    generation = catalogue_cache.generation()
+    cacheable = catalogue_cache.cacheable(len(book_ids))
+    if cacheable:
+        books_by_id, missing = catalogue_cache.get_books(book_ids)
+    else:
+        books_by_id, missing = {}, list(book_ids)
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        rows = [CachedBook(*row) for row in
+                db.session.query(*CATALOGUE_COLUMNS).filter(Book.id.in_(chunk)).all()]
+        if cacheable:
+            catalogue_cache.put_books(rows, generation)
+        books_by_id.update((row.id, row) for row in rows)
+    return [books_by_id[book_id] for book_id in book_ids if book_id in books_by_id]
+
+def lookup_book_ids(query_params, fuzzy=True):
+    """Run the search index cascade, caching the matching ids by normalised query"""
+    book_ids = catalogue_cache.get_lookup(query_params, fuzzy)
+    if book_ids is None:
+        generation = catalogue_cache.generation()
+        with span('search.sync'):
+            search_index.sync()
+        book_ids = search_index.lookup(query_params, fuzzy=fuzzy)
+        catalogue_cache.put_lookup(query_params, book_ids, generation, fuzzy)
+    return book_ids
+
+def books_on_loan(borrower_id=None):
+    """Books with at least one open loan, optionally only those of one borrower"""
+    open_loans = db.session.query(BorrowRecord.book_id).filter(BorrowRecord.returned == False)
+    if borrower_id:
+        open_loans = open_loans.filter(BorrowRecord.borrower_id == borrower_id)
+    rows = db.session.query(*CATALOGUE_COLUMNS).filter(Book.id.in_(open_loans.distinct())).order_by(Book.id).all()
+    return [CachedBook(*row) for row in rows]
+
+def is_return_query(query_params):
+    return 'return' in (query_params.get('intent') or '').lower()
 
 def search_books(query_params):
     """Helper function to search books based on query parameters"""
-    books = []
+    # Title, category, author and general search term are resolved in a
+    # single lookup against the in-memory index instead of ILIKE scans
+    return_query = is_return_query(query_params)
+    book_ids = lookup_book_ids(query_params, fuzzy=not return_query)
+    with span('search.load'):
+        books = load_books(book_ids)
     
-    # If we have a specific title, search by title first
-    if query_params['title']:
-        title_query = query_params['title'].strip()
-        title_matches = Book.query.filter(
-            Book.title.ilike(f"%{title_query}%")
-        ).all()
-        books.extend(title_matches)
+    # If still no matches and it's a return query, list the books that are
+    # out on loan (to the requesting borrower, if known) in one query, and
+    # only then try typo-tolerant matching
+    if not books and return_query:
+        with span('search.return_fallback'):
+            books = books_on_loan(query_params.get('borrower_id'))
+        if not books:
+            books = load_books(lookup_book_ids(query_params))
     
-    # If no title matches or no title provided, try category
-    if not books and query_params['category']:
-        category_query = query_params['category'].strip()
-        category_matches = Book.query.filter(
-            Book.category.ilike(f"%{category_query}%")
-        ).all()
-        books.extend(category_matches)
-    
-    # If still no matches, try author
-    if not books and query_params['author']:
-        author_query = query_params['author'].strip()
-        author_matches = Book.query.filter(
-            Book.author.ilike(f"%{author_query}%")
-        ).all()
-        books.extend(author_matches)
+    return books
+
+def search_books_batch(queries_params):
+    """Search for several queries at once, loading all matching books together"""
+    generation = catalogue_cache.generation()
+    # Return queries skip typo-tolerant matching until the books on loan are tried
+    fuzzy = [not is_return_query(query_params) for query_params in queries_params]
+    id_lists = [catalogue_cache.get_lookup(query_params, fuzzy[i]) for i, query_params in enumerate(queries_params)]
+    if None in id_lists:
+        search_index.sync()
+        for i, query_params in enumerate(queries_params):
+            if id_lists[i] is None:
+                id_lists[i] = search_index.lookup(query_params, fuzzy=fuzzy[i])
+                catalogue_cache.put_lookup(query_params, id_lists[i], generation, fuzzy[i])
+    unique_ids = list(dict.fromkeys(book_id for book_ids in id_lists for book_id in book_ids))
+    books_by_id = {book.id: book for book in load_books(unique_ids)}
     
-    # If still no matches and we have a search term, try general search
-    if not books and query_params['search_term']:
-        search_query = query_params['search_term'].strip()
-        matches = Book.query.filter(
-            db.or_(
-                Book.title.ilike(f"%{search_query}%"),
-                Book.author.ilike(f"%{search_query}%"),
-                Book.category.ilike(f"%{search_query}%")
-            )
-        ).all()
-        books.extend(matches)
+    results = [[books_by_id[book_id] for book_id in book_ids if book_id in books_by_id]
+               for book_ids in id_lists]
     
-    # If still no matches and it's a return query, try searching in borrow records
-    if not books and 'return' in query_params.get('intent', '').lower():
-        unreturned_records = BorrowRecord.query.filter_by(returned=False).all()
-        for record in unreturned_records:
-            book = Book.query.get(record.book_id)
-            if book and book not in books:
-                books.append(book)
+    # Return queries without matches share one open-loans query per borrower
+    on_loan = {}
+    for i, query_params in enumerate(queries_params):
+        if not results[i] and is_return_query(query_params):
+            borrower_id = query_params.get('borrower_id')
+            if borrower_id not in on_loan:
+                on_loan[borrower_id] = books_on_loan(borrower_id)
+            results[i] = on_loan[borrower_id] or load_books(lookup_book_ids(query_params))
+    return results
+
+book_to_dict = record_serializer(DEFAULT_BOOK_FIELDS)
+
+def query_response(result, books):
+    """Build the /api/query response body for an interpreted query and its matches"""
+    # Convert books to dictionary format
+    unique_books = []
+    seen = set()
+    for book in books:
+        if book.id not in seen:
+            seen.add(book.id)
+            unique_books.append(book_to_dict(book))
     
-    return books
+    return {
+        'intent': result['intent'],
+        'entities': {
+            'title': result['title'],
+            'author': result['author'],
+            'category': result['category'],
+            'search_term': result['search_term']
+        },
+        'message': 'Query processed successfully',
+        'books': unique_books,
+        'natural_response': library_agent.format_response(unique_books, result['intent'])
+    }
 
-@app.route('/')
+@bp.route('/')
 def home():
     return render_template('index.html')
 
-@app.route('/api/query', methods=['POST'])
-@async_route
-async def process_query():
+@bp.route('/api/query', methods=['POST'])
+def process_query():
     try:
         data = request.json
         query = data.get('query', '')
         
-        # Process query using Gemini AI
-        result = await library_agent.process_query(query)
-        
-        response = {
-            'intent': result['intent'],
-            'entities': {
-                'title': result['title'],
-                'author': result['author'],
-                'category': result['category'],
-                'search_term': result['search_term']
-            },
-            'message': 'Query processed successfully'
-        }
+        # Process query using Gemini AI on the shared event loop; this
+        # thread waits while other requests' model calls proceed
+        with span('interpret'):
+            result = run_async(library_agent.process_query(query))
+        result['borrower_id'] = data.get('borrower_id')
         
         try:
             # Search for books
             books = search_books(result)
-            
-            # Convert books to dictionary format
-            unique_books = []
-            seen = set()
-            for book in books:
-                if book.id not in seen:
-                    seen.add(book.id)
-                    unique_books.append({
-                        'book_id': book.book_id,
-                        'title': book.title,
-                        'author': book.author,
-                        'available': book.available,
-                        'quantity': book.quantity,
-                        'category': book.category,
-                        'location': book.location
-                    })
-            
-            response['books'] = unique_books
-            response['natural_response'] = library_agent.format_response(unique_books, result['intent'])
-            
-            return jsonify(response)
+            with span('serialize'):
+                return json_response(query_response(result, books))
             
         except Exception as e:
             return jsonify({'error': f'Error searching books: {str(e)}'}), 500
@@ -130,174 +201,588 @@ async def process_query():
     except Exception as e:
         return jsonify({'error': f'Error processing query: {str(e)}'}), 500
 
-@app.route('/api/books/<string:book_id>/borrow', methods=['POST'])
-def borrow_book(book_id):
+def sse_event(event, data):
+    return f'event: {event}\ndata: {dumps(data).decode()}\n\n'
+
+@bp.route('/api/query/stream', methods=['POST'])
+def process_query_stream():
+    """Server-Sent Events version of /api/query.
+
+    Events: "local" with results for the locally parsed query (only sent
+    when the model is consulted), "model" with chunks of model output as
+    they arrive, "result" with the final response, then "done".
+    """
+    data = request.json or {}
+    query = data.get('query', '')
+    borrower_id = data.get('borrower_id')
+    
+    def events():
+        try:
+            for kind, payload in iterate_async(library_agent.stream_query(query)):
+                if kind == 'model_text':
+                    yield sse_event('model', {'text': payload})
+                    continue
+                payload['borrower_id'] = borrower_id
+                books = search_books(payload)
+                yield sse_event('local' if kind == 'local' else 'result', query_response(payload, books))
+        except Exception as e:
+            yield sse_event('error', {'error': f'Error processing query: {str(e)}'})
+        yield sse_event('done', {})
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@bp.route('/api/query/batch', methods=['POST'])
+def process_query_batch():
+    """Interpret and answer a list of queries; results are returned in input order.
+
+    Body: {"queries": [...], "borrower_id": optional, "concurrency": optional}
+    """
     try:
-        book = Book.query.filter_by(book_id=book_id).first_or_404()
-        
-        if book.available <= 0:
-            return jsonify({'error': 'Book is not available for borrowing'}), 400
+        data = request.json or {}
+        queries = data.get('queries')
+        if not isinstance(queries, list) or not queries or not all(isinstance(q, str) for q in queries):
+            return jsonify({'error': 'Expected a non-empty list of query strings'}), 400
+        if len(queries) > MAX_QUERY_BATCH_SIZE:
+            return jsonify({'error': f'At most {MAX_QUERY_BATCH_SIZE} queries per batch'}), 400
+        try:
+            concurrency = min(int(data.get('concurrency') or QUERY_BATCH_CONCURRENCY), QUERY_BATCH_CONCURRENCY)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'concurrency must be an integer'}), 400
         
-        book.available -= 1
+        # Interpret each distinct query once, with at most `concurrency` model calls in flight
+        unique_queries = {}
+        for query in queries:
+            unique_queries.setdefault(QueryCache.normalize(query), query)
+        interpretations = run_async(library_agent.process_queries(list(unique_queries.values()), max(1, concurrency)))
+        for result in interpretations:
+            result['borrower_id'] = data.get('borrower_id')
         
+        try:
+            books = search_books_batch(interpretations)
+            by_query = {
+                key: query_response(result, matches)
+                for key, result, matches in zip(unique_queries, interpretations, books)
+            }
+            return json_response({
+                'results': [dict(by_query[QueryCache.normalize(query)], query=query) for query in queries]
+            })
+            
+        except Exception as e:
+            return jsonify({'error': f'Error searching books: {str(e)}'}), 500
+            
+    except Exception as e:
+        return jsonify({'error': f'Error processing queries: {str(e)}'}), 500
+
+@bp.route('/api/query/stats', methods=['GET'])
+def query_stats():
+    return jsonify(dict(library_agent.get_stats(), catalogue_cache=catalogue_cache.get_stats(),
+                        recommendations=recommendations.get_stats()))
+
+@bp.route('/api/books/<string:book_id>/borrow', methods=['POST'])
+def borrow_book(book_id):
+    try:
         # Get borrower details from request
-        data = request.json
-        borrow_record = BorrowRecord(
-            book_id=book.id,
-            borrower_name=data['borrower_name'],
-            borrower_email=data.get('borrower_email'),
-            borrower_phone=data.get('borrower_phone'),
-            borrower_id=data.get('borrower_id'),
-            due_date=datetime.utcnow() + timedelta(days=14),  # 2 weeks loan period
-            condition_on_borrow='Good'
-        )
+        data = request.json or {}
+        if not data.get('borrower_name'):
+            return jsonify({'error': 'Missing required field: borrower_name'}), 400
         
-        db.session.add(borrow_record)
-        db.session.commit()
+        committed = []
         
-        return jsonify({
-            'message': f'Successfully borrowed "{book.title}". Due date: {borrow_record.due_date}',
-            'due_date': borrow_record.due_date.isoformat()
-        })
+        def borrow():
+            # Decrement in a single conditional UPDATE so concurrent borrows
+            # can never take the same copy or drive availability negative
+            updated = Book.query.filter(
+                Book.book_id == book_id,
+                Book.available > 0
+            ).update({Book.available: Book.available - 1}, synchronize_session=False)
+            
+            book = Book.query.filter_by(book_id=book_id).first_or_404()
+            if not updated:
+                db.session.rollback()
+                return jsonify({'error': 'Book is not available for borrowing'}), 400
+            
+            borrow_record = BorrowRecord(
+                book_id=book.id,
+                borrower_name=data['borrower_name'],
+                borrower_email=data.get('borrower_email'),
+                borrower_phone=data.get('borrower_phone'),
+                borrower_id=data.get('borrower_id'),
+                due_date=datetime.utcnow() + timedelta(days=14),  # 2 weeks loan period
+                condition_on_borrow='Good'
+            )
+            
+            db.session.add(borrow_record)
+            with span('db.commit', operation='borrow'):
+                db.session.commit()
+            committed.append(book.id)
+            
+            return jsonify({
+                'message': f'Successfully borrowed "{book.title}". Due date: {borrow_record.due_date}',
+                'due_date': borrow_record.due_date.isoformat()
+            })
+        
+        response = run_with_retry(borrow)
+        # After the commit, outside the retried function: a failure here
+        # must neither repeat the borrow nor report it as failed
+        if committed:
+            catalogue_cache.invalidate_book(committed[0])
+            try:
+                with span('recommendations.sync'):
+                    recommendations.sync()
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f'Error updating recommendations: {str(e)}')
+        return response
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Error borrowing book: {str(e)}'}), 500
 
-@app.route('/api/books/<string:book_id>/return', methods=['POST'])
+@bp.route('/api/books/<string:book_id>/return', methods=['POST'])
 def return_book(book_id):
     try:
-        book = Book.query.filter_by(book_id=book_id).first_or_404()
+        # Get return condition and, optionally, the returning borrower
+        data = request.json or {}
+        borrower_id = data.get('borrower_id')
         
-        if book.available >= book.quantity:
-            return jsonify({'error': 'All copies of this book are already returned'}), 400
-        
-        # Find the active borrow record
-        borrow_record = BorrowRecord.query.filter_by(
-            book_id=book.id,
-            returned=False
-        ).first()
-        
-        if not borrow_record:
-            return jsonify({'error': 'No active borrow record found for this book'}), 404
-        
-        book.available += 1
-        borrow_record.returned = True
-        borrow_record.return_date = datetime.utcnow()
-        
-        # Get return condition from request
-        data = request.json
-        borrow_record.condition_on_return = data.get('condition', 'Good')
-        
-        # Calculate any fines
-        fine = borrow_record.calculate_fine()
-        borrow_record.fine_amount = fine
-        
-        db.session.commit()
-        
-        response = {
-            'message': f'Successfully returned "{book.title}"',
-            'fine_amount': fine
-        }
-        
-        if fine > 0:
-            response['fine_message'] = f'Late return fine: ${fine:.2f}'
+        def return_copy():
+            # Increment first so this transaction holds the write lock on the
+            # book before it picks which loan to close
+            updated = Book.query.filter(
+                Book.book_id == book_id,
+                Book.available < Book.quantity
+            ).update({Book.available: Book.available + 1}, synchronize_session=False)
+            
+            book = Book.query.filter_by(book_id=book_id).first_or_404()
+            if not updated:
+                db.session.rollback()
+                return jsonify({'error': 'All copies of this book are already returned'}), 400
+            
+            # Find the active borrow record: the borrower's own loan when
+            # they are known, otherwise the oldest open loan of the book
+            loans = BorrowRecord.query.filter_by(book_id=book.id, returned=False)
+            if borrower_id:
+                loans = loans.filter_by(borrower_id=borrower_id)
+            borrow_record = loans.order_by(BorrowRecord.id).with_for_update().first()
+            
+            if not borrow_record:
+                db.session.rollback()
+                if borrower_id:
+                    return jsonify({'error': f'No active loan of this book for borrower {borrower_id}'}), 404
+                return jsonify({'error': 'No active borrow record found for this book'}), 404
+            
+            borrow_record.returned = True
+            borrow_record.return_date = datetime.utcnow()
+            borrow_record.condition_on_return = data.get('condition', 'Good')
+            
+            # Calculate any fines
+            fine = borrow_record.calculate_fine()
+            borrow_record.fine_amount = fine
+            
+            with span('db.commit', operation='return'):
+                db.session.commit()
+            catalogue_cache.invalidate_book(book.id)
+            
+            response = {
+                'message': f'Successfully returned "{book.title}"',
+                'fine_amount': fine
+            }
+            
+            if fine > 0:
+                response['fine_message'] = f'Late return fine: ${fine:.2f}'
+            
+            return jsonify(response)
         
-        return jsonify(response)
+        return run_with_retry(return_copy)
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Error returning book: {str(e)}'}), 500
 
-@app.route('/api/books', methods=['GET'])
+@bp.route('/api/books', methods=['GET'])
 def get_books():
+    """List books, optionally filtered, projected and paginated.
+
+    Query parameters:
+        limit     page size (at most MAX_PAGE_SIZE); without it every
+                  matching book is streamed
+        cursor    value of the X-Next-Cursor header from the previous page
+        category, location   exact-match filters
+        available            "true" to list only books with free copies
+        fields    comma-separated subset of BOOK_FIELDS
+    """
     try:
-        books = Book.query.all()
-        return jsonify([{
-            'book_id': book.book_id,
-            'title': book.title,
-            'author': book.author,
-            'available': book.available,
-            'quantity': book.quantity,
-            'category': book.category,
-            'location': book.location
-        } for book in books])
+        args = request.args
+        fields = [field.strip() for field in args.get('fields', '').split(',') if field.strip()]
+        fields = fields or list(DEFAULT_BOOK_FIELDS)
+        unknown = [field for field in fields if field not in BOOK_FIELDS]
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+
+        try:
+            limit, cursor = parse_page_args(args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Only the requested columns are selected; rows are plain tuples
+        query = db.session.query(Book.id, *[getattr(Book, field) for field in fields])
+        if args.get('category'):
+            query = query.filter(Book.category == args['category'])
+        if args.get('location'):
+            query = query.filter(Book.location == args['location'])
+        if args.get('available', '').lower() in ('1', 'true', 'yes'):
+            query = query.filter(Book.available > 0)
+
+        return paginated_json_response(query, Book.id, row_serializer(fields), limit, cursor)
     except Exception as e:
         return jsonify({'error': f'Error fetching books: {str(e)}'}), 500
 
-@app.route('/api/books', methods=['POST'])
+REQUIRED_BOOK_FIELDS = ['title', 'author', 'quantity']
+MAX_BATCH_SIZE = 1000
+
+def validate_new_book(data):
+    """Return an error message for an invalid add-book payload, or None"""
+    if not isinstance(data, dict):
+        return 'Book must be a JSON object'
+    # Check for required fields
+    for field in REQUIRED_BOOK_FIELDS:
+        if not data.get(field):
+            return f'Missing required field: {field}'
+    try:
+        if int(data['quantity']) < 1:
+            return 'quantity must be a positive integer'
+    except (TypeError, ValueError):
+        return 'quantity must be a positive integer'
+    return None
+
+def new_book_row(data, book_id):
+    return {
+        'book_id': book_id,
+        'title': data['title'],
+        'author': data['author'],
+        'isbn': data.get('isbn') or None,
+        'quantity': int(data['quantity']),
+        'available': int(data['quantity']),  # Initially all copies are available
+        'category': data.get('category') or 'Uncategorized',
+        'location': data.get('location') or 'General Collection'
+    }
+
+@bp.route('/api/books', methods=['POST'])
 def add_book():
     try:
         data = request.json
-        required_fields = ['title', 'author', 'quantity']
-        
-        # Check for required fields
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'error': f'Missing required field: {field}'}), 400
+        error = validate_new_book(data)
+        if error:
+            return jsonify({'error': error}), 400
         
         # Generate a unique book ID (format: LIB-YYYY-XXXX)
-        year = datetime.utcnow().year
-        last_book = Book.query.order_by(Book.book_id.desc()).first()
-        if last_book and last_book.book_id.startswith(f'LIB-{year}-'):
-            last_num = int(last_book.book_id.split('-')[-1])
-            new_num = str(last_num + 1).zfill(4)
-        else:
-            new_num = '0001'
-        book_id = f'LIB-{year}-{new_num}'
+        book_id = book_id_allocator.allocate()[0]
         
-        # Create new book
-        new_book = Book(
-            book_id=book_id,
-            title=data['title'],
-            author=data['author'],
-            isbn=data.get('isbn'),
-            quantity=int(data['quantity']),
-            available=int(data['quantity']),  # Initially all copies are available
-            category=data.get('category', 'Uncategorized'),
-            location=data.get('location', 'General Collection')
-        )
-        
-        db.session.add(new_book)
+        # Create new book; the response echoes the inserted row, so nothing
+        # is read back after the commit
+        row = new_book_row(data, book_id)
+        db.session.execute(Book.__table__.insert(), [row])
         db.session.commit()
+        search_index.sync()
+        catalogue_cache.invalidate_lookups()
         
-        return jsonify({
+        return json_response({
             'message': 'Book added successfully',
-            'book': {
-                'book_id': new_book.book_id,
-                'title': new_book.title,
-                'author': new_book.author,
-                'isbn': new_book.isbn,
-                'quantity': new_book.quantity,
-                'available': new_book.available,
-                'category': new_book.category,
-                'location': new_book.location
-            }
-        }), 201
+            'book': row
+        }, 201)
         
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f'Error adding book: {str(e)}')
+        current_app.logger.error(f'Error adding book: {str(e)}')
         return jsonify({'error': f'Error adding book: {str(e)}'}), 500
 
-@app.route('/api/books/<string:book_id>/history', methods=['GET'])
+@bp.route('/api/books/batch', methods=['POST'])
+def add_books_batch():
+    """Add many books in one transaction; body is {"books": [...]} or a list"""
+    try:
+        data = request.json
+        books = data.get('books') if isinstance(data, dict) else data
+        if not isinstance(books, list) or not books:
+            return jsonify({'error': 'Expected a non-empty list of books'}), 400
+        if len(books) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'At most {MAX_BATCH_SIZE} books per batch'}), 400
+        
+        for index, book in enumerate(books):
+            error = validate_new_book(book)
+            if error:
+                return jsonify({'error': f'Book {index}: {error}'}), 400
+        
+        book_ids = book_id_allocator.allocate(len(books))
+        rows = [new_book_row(book, book_id) for book, book_id in zip(books, book_ids)]
+        db.session.execute(Book.__table__.insert(), rows)
+        db.session.commit()
+        search_index.sync()
+        catalogue_cache.invalidate_lookups()
+        
+        return json_response({
+            'message': f'Added {len(rows)} books',
+            'books': rows
+        }, 201)
+        
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f'Error adding books: {str(e)}')
+        return jsonify({'error': f'Error adding books: {str(e)}'}), 500
+
+HISTORY_FIELDS = ('borrower_name', 'borrowed_date', 'due_date', 'return_date', 'returned', 'fine_amount')
+
+def parse_date_arg(value, end_of_range=False):
+    """Parse an ISO date/datetime.
+
+    A range end is returned as an exclusive bound that still includes the
+    value given: the next day for a bare date, the next microsecond (the
+    finest stored resolution) for a datetime.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid date: {value}')
+    if end_of_range:
+        parsed += timedelta(days=1) if len(value) == 10 else timedelta(microseconds=1)
+    return parsed
+
+@bp.route('/api/books/<string:book_id>/history', methods=['GET'])
 def get_book_history(book_id):
+    """Borrow history of a book.
+
+    Query parameters:
+        from, to   ISO dates or datetimes bounding borrowed_date (both
+                   inclusive; a date as `to` includes that whole day)
+        limit, cursor   keyset pagination, as for GET /api/books
+        summary    "true" to return aggregates computed in SQL instead
+                   of the individual records
+    """
     try:
         book = Book.query.filter_by(book_id=book_id).first_or_404()
-        records = BorrowRecord.query.filter_by(book_id=book.id).all()
+        args = request.args
+        try:
+            start = parse_date_arg(args.get('from'))
+            end = parse_date_arg(args.get('to'), end_of_range=True)
+            limit, cursor = parse_page_args(args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        filters = [BorrowRecord.book_id == book.id]
+        if start:
+            filters.append(BorrowRecord.borrowed_date >= start)
+        if end:
+            filters.append(BorrowRecord.borrowed_date < end)
+        
+        if args.get('summary', '').lower() in ('1', 'true', 'yes'):
+            loan_days = days_between(BorrowRecord.borrowed_date, BorrowRecord.return_date)
+            summary = db.session.query(
+                db.func.count(BorrowRecord.id),
+                db.func.sum(db.case((BorrowRecord.returned == False, 1), else_=0)),
+                db.func.avg(loan_days),
+                db.func.sum(BorrowRecord.fine_amount),
+                db.func.count(db.func.distinct(
+                    db.func.coalesce(BorrowRecord.borrower_id, BorrowRecord.borrower_name)
+                ))
+            ).filter(*filters).one()
+            loan_count, open_loans, average_days, total_fines, distinct_borrowers = summary
+            return json_response({
+                'book_id': book.book_id,
+                'loan_count': loan_count,
+                'open_loans': open_loans or 0,
+                'average_loan_days': round(float(average_days), 2) if average_days is not None else None,
+                'total_fines': float(total_fines or 0.0),
+                'distinct_borrowers': distinct_borrowers
+            })
         
-        return jsonify([{
-            'borrower_name': record.borrower_name,
-            'borrowed_date': record.borrowed_date.isoformat(),
-            'due_date': record.due_date.isoformat(),
-            'return_date': record.return_date.isoformat() if record.return_date else None,
-            'returned': record.returned,
-            'fine_amount': record.fine_amount
-        } for record in records])
+        query = db.session.query(
+            BorrowRecord.id, *[getattr(BorrowRecord, field) for field in HISTORY_FIELDS]
+        ).filter(*filters)
+        return paginated_json_response(query, BorrowRecord.id, row_serializer(HISTORY_FIELDS), limit, cursor)
     except Exception as e:
         return jsonify({'error': f'Error fetching book history: {str(e)}'}), 500
 
-if __name__ == '__main__':
+OVERDUE_FIELDS = ('book_id', 'title', 'borrower_name', 'borrower_id', 'due_date',
+                  'days_overdue', 'fine_amount', 'computed_at')
+FINE_FIELDS = ('borrower_name', 'borrower_id', 'overdue_loans', 'fine_amount',
+               'oldest_due_date', 'computed_at')
+
+@bp.route('/api/overdue', methods=['GET'])
+def get_overdue():
+    """Overdue loans as of the last overdue refresh, longest overdue first.
+
+    Query parameters:
+        limit, cursor   keyset pagination, as for GET /api/books
+        borrower_id     only this borrower's loans (their name, for loans
+                        recorded without an id)
+    """
+    try:
+        try:
+            limit, cursor = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        query = db.session.query(OverdueLoan.id, *[getattr(OverdueLoan, field) for field in OVERDUE_FIELDS])
+        if request.args.get('borrower_id'):
+            query = query.filter(OverdueLoan.borrower_key == request.args['borrower_id'])
+        return paginated_json_response(query, OverdueLoan.id, row_serializer(OVERDUE_FIELDS), limit, cursor)
+    except Exception as e:
+        return jsonify({'error': f'Error fetching overdue loans: {str(e)}'}), 500
+
+@bp.route('/api/fines', methods=['GET'])
+def get_fines():
+    """Fines accrued per borrower on overdue loans as of the last refresh, largest first"""
+    try:
+        try:
+            limit, cursor = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        query = db.session.query(BorrowerFine.id, *[getattr(BorrowerFine, field) for field in FINE_FIELDS])
+        return paginated_json_response(query, BorrowerFine.id, row_serializer(FINE_FIELDS), limit, cursor)
+    except Exception as e:
+        return jsonify({'error': f'Error fetching fines: {str(e)}'}), 500
+
+LOAN_FIELDS = ('book_id', 'title', 'borrowed_date', 'due_date', 'return_date', 'returned', 'fine_amount')
+LOAN_COLUMNS = (BorrowRecord.id, Book.book_id, Book.title, BorrowRecord.borrowed_date, BorrowRecord.due_date,
+                BorrowRecord.return_date, BorrowRecord.returned, BorrowRecord.fine_amount)
+LOAN_STATUSES = {'open': [False], 'returned': [True], 'all': [False, True]}
+
+@bp.route('/api/borrowers/<string:borrower_id>/loans', methods=['GET'])
+def get_borrower_loans(borrower_id):
+    """A borrower's loans, oldest first.
+
+    Query parameters:
+        status          "open" (default), "returned" or "all"
+        limit, cursor   keyset pagination, as for GET /api/books
+    """
+    try:
+        status = request.args.get('status', 'open').lower()
+        if status not in LOAN_STATUSES:
+            return jsonify({'error': f'status must be one of {", ".join(LOAN_STATUSES)}'}), 400
+        try:
+            limit, cursor = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Equality on borrower_id and returned keeps this on ix_borrow_record_borrower_id
+        query = db.session.query(*LOAN_COLUMNS).join(Book, Book.id == BorrowRecord.book_id).filter(
+            BorrowRecord.borrower_id == borrower_id,
+            BorrowRecord.returned.in_(LOAN_STATUSES[status])
+        )
+        return paginated_json_response(query, BorrowRecord.id, row_serializer(LOAN_FIELDS), limit, cursor)
+    except Exception as e:
+        return jsonify({'error': f'Error fetching loans: {str(e)}'}), 500
+
+MAX_RECOMMENDATIONS = 50
+
+def parse_limit_arg(args, default=10):
+    try:
+        limit = int(args.get('limit') or default)
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if not 1 <= limit <= MAX_RECOMMENDATIONS:
+        raise ValueError(f'limit must be between 1 and {MAX_RECOMMENDATIONS}')
+    return limit
+
+def scored_books(scores):
+    """Book dicts with a score for (book pk, score) pairs, in the same order"""
+    books_by_id = {book.id: book for book in load_books([book_pk for book_pk, _ in scores])}
+    return [dict(book_to_dict(books_by_id[book_pk]), score=round(score, 4))
+            for book_pk, score in scores if book_pk in books_by_id]
+
+@bp.route('/api/books/<string:book_id>/similar', methods=['GET'])
+def get_similar_books(book_id):
+    """Books most often borrowed by the same borrowers as this one (`limit`, default 10)"""
+    try:
+        try:
+            limit = parse_limit_arg(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        book = db.session.query(Book.id).filter(Book.book_id == book_id).first()
+        if book is None:
+            return jsonify({'error': 'Book not found'}), 404
+        
+        with span('recommendations.sync'):
+            recommendations.sync()
+        return json_response({
+            'book_id': book_id,
+            'similar': scored_books(recommendations.similar(book.id, limit))
+        })
+    except Exception as e:
+        return jsonify({'error': f'Error fetching similar books: {str(e)}'}), 500
+
+@bp.route('/api/borrowers/<string:borrower_id>/recommendations', methods=['GET'])
+def get_recommendations(borrower_id):
+    """Books similar to those a borrower has borrowed, excluding those (`limit`, default 10)"""
+    try:
+        try:
+            limit = parse_limit_arg(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        with span('recommendations.sync'):
+            recommendations.sync()
+        return json_response({
+            'borrower_id': borrower_id,
+            'recommendations': scored_books(recommendations.recommend(borrower_id, limit))
+        })
+    except Exception as e:
+        return jsonify({'error': f'Error fetching recommendations: {str(e)}'}), 500
+
+def create_app(database_url=None, warm=False, scheduler=None):
+    """Application factory.
+
+    With warm=True the schema is upgraded, the search and recommendation
+    indexes built and the model SDK imported up front, and pooled
+    connections are closed again, so a pre-forking server
+    (gunicorn --preload 'app:create_app(warm=True)')
+    does this once and its workers share the result.
+
+    With scheduler=True (by default, the OVERDUE_SCHEDULER setting) this
+    process also refreshes overdue loans and fines in the background.
+    Only one process should: a pre-forking server would start it in the
+    master, so run `python overdue.py --every N` next to one instead.
+    """
+    app = Flask(__name__, static_folder='static', static_url_path='/static')
+    configure_database(app, database_url)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    
+    db.init_app(app)
+    instrumentation.init_app(app)
+    app.register_blueprint(bp)
+    if warm:
+        warm_up(app)
+    if scheduler is None:
+        scheduler = OVERDUE_SCHEDULER
+    if scheduler:
+        app.extensions['overdue_scheduler'] = OverdueScheduler(app)
+        app.extensions['overdue_scheduler'].start()
+    return app
+
+def warm_up(app):
     with app.app_context():
-        db.create_all()
+        upgrade()
+        search_index.rebuild()
+        recommendations.rebuild()
+        library_agent.model
+        db.session.remove()
+        # Forked workers must open their own connections
+        db.get_engine(app).dispose()
+
+# Scripts import this instance too, so it never starts the scheduler
+# itself; python app.py does below
+app = create_app(scheduler=False)
+
+if __name__ == '__main__':
+    # With debug=True the reloader re-runs this module in a child process
+    # that serves the requests; start the scheduler only there
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up(app)
+        OverdueScheduler(app).start()
     app.run(debug=True)
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import threading
+from typing import Any, AsyncIterator, Awaitable, Iterator, Optional
+
+
+class EventLoopThread:
+    """A single asyncio event loop running in a background thread.
+
+    Request threads hand coroutines to the loop and block on the result, so
+    many model calls can be in flight at once without creating and tearing
+    down a loop per request.  The loop is started lazily, and restarted in a
+    forked worker process, where the parent's thread no longer exists.
+    """
+
+    def __init__(self, name: str = 'async-runtime'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._pid = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid() or not self._thread.is_alive():
+                    self._start()
+        return self._loop
+
+    def _start(self):
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, name=self.name, daemon=True)
+        thread.start()
+        ready.wait()
+        self._loop, self._thread, self._pid = loop, thread, os.getpid()
+
+    def run(self, coro: Awaitable, timeout: Optional[float] = None) -> Any:
+        """Run `coro` on the loop and wait for its result"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+            self._loop = self._thread = self._pid = None
+
+    def iterate(self, agen: AsyncIterator, timeout: Optional[float] = None) -> Iterator:
+        """Drive an async generator on the loop from synchronous code"""
+        async def next_item():
+            return await agen.__anext__()
+
+        try:
+            while True:
+                try:
+                    yield self.run(next_item(), timeout)
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(agen.aclose(), timeout)
+
+
+runtime = EventLoopThread()
+
+
+def run_async(coro: Awaitable, timeout: Optional[float] = None) -> Any:
+    return runtime.run(coro, timeout)
+
+
+def iterate_async(agen: AsyncIterator, timeout: Optional[float] = None) -> Iterator:
+    return runtime.iterate(agen, timeout)
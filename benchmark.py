@@ -0,0 +1,1151 @@
+"""Benchmarks for the library API.
+
+Each benchmark runs against a throwaway SQLite database filled with a
+synthetic catalogue and loan history, with GeminiLibraryAgent's model
+replaced by a deterministic local fake, so it never touches library.db or
+the network.  Results are printed as JSON; --output saves them and
+--compare reports the change against a saved run.
+
+Usage:
+    python benchmark.py api --books 100000 --loans 200000 --threads 1,8 --requests 2000
+    python benchmark.py search --books 100000 --queries 200
+    python benchmark.py borrow --threads 1,4,16 --ops 200
+    python benchmark.py return-fallback --books 20000 --loans 10000
+    python benchmark.py loans --books 100000 --loans 500000
+    python benchmark.py overdue --books 100000 --loans 500000
+    python benchmark.py startup --runs 5
+    python benchmark.py serialization --books 100000
+    python benchmark.py catalogue --books 100000 --loans 20000
+    python benchmark.py recommendations --books 100000 --loans 200000
+    python benchmark.py model --model-timeout 0.2
+    python benchmark.py sync --threads 8 --ops 20 --database-url postgresql://localhost/library_bench
+    python benchmark.py api --output before.json
+    python benchmark.py api --compare before.json
+    python benchmark.py api --database-url postgresql://localhost/library_bench
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from ai_agent import CircuitBreaker, ModelClient, ModelUnavailable, QueryCache
+from app import app, library_agent, search_books
+from catalogue_cache import catalogue_cache
+from catalogue_import import export_catalogue, import_catalogue
+from database import configure_database, sqlite_pragmas
+from models import db, Book, BorrowerFine, BorrowRecord
+from overdue import refresh_overdue
+from recommendations import recommendations
+from search_index import search_index
+from serialization import GZIP_LEVEL, dumps, row_serializer
+
+WORDS = [
+    'time', 'history', 'python', 'garden', 'night', 'river', 'winter', 'secret',
+    'empire', 'machine', 'ocean', 'shadow', 'kingdom', 'silent', 'golden', 'lost',
+    'journey', 'stars', 'code', 'data', 'war', 'peace', 'light', 'dark', 'city',
+    'mountain', 'storm', 'dream', 'glass', 'fire', 'iron', 'memory', 'island',
+]
+FIRST_NAMES = ['John', 'Jane', 'Harper', 'Stephen', 'Ada', 'Mary', 'George', 'Leo', 'Toni', 'Alan']
+LAST_NAMES = ['Smith', 'Doe', 'Lee', 'Hawking', 'Lovelace', 'Shelley', 'Orwell', 'Tolstoy', 'Morrison', 'Turing']
+CATEGORIES = ['Fiction', 'Non-Fiction', 'Programming', 'Science', 'History']
+
+
+def use_temp_database():
+    """Point the app at a fresh SQLite file and return its path"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    configure_database(app, f'sqlite:///{path}')
+    return path
+
+
+def use_database(url):
+    """Point the app at an existing database, refusing one that already has tables"""
+    configure_database(app, url)
+    with app.app_context():
+        tables = db.inspect(db.engine).get_table_names()
+    if tables:
+        raise SystemExit(f'{url} is not empty ({", ".join(tables)}); use a scratch database')
+
+
+def generate_books(count, seed=0, chunk_size=5000):
+    """Insert `count` synthetic books using batched core inserts"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(1, count + 1):
+        rows.append({
+            'book_id': f'BEN-{i:07d}',
+            'title': ' '.join(rng.choice(WORDS).title() for _ in range(rng.randint(2, 4))),
+            'author': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            'category': rng.choice(CATEGORIES),
+            'location': f'Shelf {rng.choice("ABCDEFGH")}{rng.randint(1, 20)}',
+            'quantity': 3,
+            'available': rng.randint(0, 3),
+        })
+        if len(rows) >= chunk_size:
+            db.session.execute(Book.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Book.__table__.insert(), rows)
+    db.session.commit()
+
+
+def sample_queries(count, seed=1):
+    """Build query parameter dicts exercising every stage of the search cascade"""
+    rng = random.Random(seed)
+    books = Book.query.order_by(db.func.random()).limit(count).all()
+    queries = []
+    for book in books:
+        params = {'intent': 'search', 'title': None, 'author': None, 'category': None, 'search_term': None}
+        stage = rng.choice(['title', 'category', 'author', 'search_term'])
+        if stage == 'title':
+            params['title'] = book.title
+        elif stage == 'category':
+            params['category'] = book.category.lower()
+        elif stage == 'author':
+            params['author'] = book.author.split()[-1]
+        else:
+            params['search_term'] = book.title.split()[0]
+        queries.append(params)
+    return queries
+
+
+def misspell(queries, seed=3):
+    """Copy title and author queries with one letter of the longest word dropped or swapped"""
+    rng = random.Random(seed)
+    misspelled = []
+    for params in queries:
+        key = 'title' if params['title'] else 'author' if params['author'] else None
+        if not key:
+            continue
+        words = params[key].split()
+        longest = max(range(len(words)), key=lambda i: len(words[i]))
+        word = words[longest]
+        if len(word) < 4:
+            continue
+        i = rng.randrange(1, len(word) - 1)
+        if rng.random() < 0.5:
+            word = word[:i] + word[i + 1:]
+        else:
+            word = word[:i - 1] + word[i] + word[i - 1] + word[i + 1:]
+        words[longest] = word
+        misspelled.append(dict(params, **{key: ' '.join(words)}))
+    return misspelled
+
+
+def ilike_search(query_params):
+    """The original ILIKE cascade, kept here as the baseline"""
+    for key, columns in (
+        ('title', [Book.title]),
+        ('category', [Book.category]),
+        ('author', [Book.author]),
+        ('search_term', [Book.title, Book.author, Book.category]),
+    ):
+        if query_params[key]:
+            term = query_params[key].strip()
+            books = Book.query.filter(db.or_(*[column.ilike(f'%{term}%') for column in columns])).all()
+            if books:
+                return books
+    return []
+
+
+def legacy_return_fallback():
+    """The original per-record lookup of books on loan, kept here as the baseline"""
+    books = []
+    for record in BorrowRecord.query.filter_by(returned=False).all():
+        book = Book.query.get(record.book_id)
+        if book and book not in books:
+            books.append(book)
+    return books
+
+
+def generate_loans(count, book_count, returned_fraction=0.0, seed=2, chunk_size=5000):
+    """Insert `count` loans spread over the first `book_count` books.
+
+    A `returned_fraction` of them are closed loans from the past year,
+    some returned late with a fine; the rest are open.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    rows = []
+    for i in range(count):
+        returned = rng.random() < returned_fraction
+        borrowed = now - timedelta(days=rng.randint(15, 365) if returned else rng.randint(0, 30))
+        due = borrowed + timedelta(days=14)
+        row = {
+            'book_id': rng.randint(1, book_count),
+            'borrower_name': f'Reader {i % 997}',
+            'borrower_id': f'M-{i % 997:04d}',
+            'borrowed_date': borrowed,
+            'due_date': due,
+            'returned': returned,
+            'return_date': None,
+            'fine_amount': 0.0,
+        }
+        if returned:
+            row['return_date'] = borrowed + timedelta(days=rng.randint(1, 21))
+            row['fine_amount'] = float(max(0, (row['return_date'] - due).days))
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            db.session.execute(BorrowRecord.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(BorrowRecord.__table__.insert(), rows)
+    db.session.commit()
+
+
+def count_statements(fn, *args):
+    """Return (result, number of SQL statements executed, seconds)"""
+    counter = {'statements': 0}
+
+    def before_cursor_execute(*_):
+        counter['statements'] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return result, counter['statements'], elapsed
+
+
+class FakeModel:
+    """Deterministic stand-in for the Gemini model.
+
+    Answers with a JSON interpretation that treats the query text as a
+    title, after a fixed delay, through both the sync and async APIs.
+    """
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+
+    def _text(self, prompt):
+        query = prompt.rsplit('Analyze this query:', 1)[-1].strip()
+        return json.dumps({'intent': 'search', 'title': query.title()})
+
+    def _response(self, text):
+        class Response:
+            pass
+        response = Response()
+        response.text = text
+        return response
+
+    def generate_content(self, prompt):
+        time.sleep(self.latency)
+        return self._response(self._text(prompt))
+
+    async def generate_content_async(self, prompt, stream=False):
+        await asyncio.sleep(self.latency)
+        text = self._text(prompt)
+        if not stream:
+            return self._response(text)
+
+        async def chunks():
+            middle = len(text) // 2
+            for part in (text[:middle], text[middle:]):
+                yield self._response(part)
+        return chunks()
+
+
+class FaultyModel(FakeModel):
+    """FakeModel that hangs for `hang` seconds (mode 'hang') or raises (mode 'raise').
+
+    With asynchronous=False it only has the sync API, so ModelClient calls
+    it on a worker thread.
+    """
+
+    def __init__(self, mode, hang=1.0, asynchronous=True):
+        super().__init__(latency=0.0)
+        self.mode = mode
+        self.hang = hang
+        self.calls = 0
+        if not asynchronous:
+            self.generate_content_async = None
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        if self.mode == 'raise':
+            raise RuntimeError('model backend error')
+        if self.mode == 'hang':
+            time.sleep(self.hang)
+        return super().generate_content(prompt)
+
+    async def generate_content_async(self, prompt, stream=False):
+        self.calls += 1
+        if self.mode == 'raise':
+            raise RuntimeError('model backend error')
+        if self.mode == 'hang':
+            await asyncio.sleep(self.hang)
+        return await super().generate_content_async(prompt, stream)
+
+
+def percentile(sorted_samples, fraction):
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * fraction))]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p95_ms': percentile(samples, 0.95) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def run_load(make_request, threads, requests):
+    """Send `requests` requests from `threads` threads; make_request(client, rng) returns a response"""
+    latencies = [[] for _ in range(threads)]
+    failures = [0] * threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(n):
+        client = app.test_client()
+        rng = random.Random(n)
+        barrier.wait()
+        for _ in range(requests // threads):
+            start = time.perf_counter()
+            response = make_request(client, rng)
+            response.get_data()
+            latencies[n].append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                failures[n] += 1
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    samples = [latency for worker_latencies in latencies for latency in worker_latencies]
+    result = summarize(samples)
+    result['threads'] = threads
+    result['requests_per_second'] = len(samples) / elapsed
+    result['errors'] = sum(failures)
+    return result
+
+
+def time_calls(fn, inputs):
+    samples = []
+    for item in inputs:
+        start = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def bench_search(args):
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        generate_books(args.books)
+        print(f'Generated {args.books} books in {time.perf_counter() - start:.2f}s')
+
+        start = time.perf_counter()
+        search_index.rebuild()
+        print(f'Built search index in {time.perf_counter() - start:.2f}s')
+
+        queries = sample_queries(args.queries)
+        title_queries = [params for params in queries if params['title']]
+        results = {
+            'books': args.books,
+            'ilike': time_calls(ilike_search, queries),
+            'index': time_calls(search_books, queries),
+        }
+        # Availability-style title lookups: the first pass fills the
+        # catalogue cache, the second is served from it
+        catalogue_cache.clear()
+        results['title_uncached'] = time_calls(search_books, title_queries)
+        results['title_cached'] = time_calls(search_books, title_queries)
+        # Lookup alone, without materialising the matching rows
+        results['index_lookup'] = time_calls(search_index.lookup, queries)
+        typos = misspell(queries)
+        results['fuzzy_lookup'] = time_calls(search_index.lookup, typos)
+        results['fuzzy_found'] = sum(1 for params in typos if search_index.lookup(params)) / max(1, len(typos))
+        results['catalogue_cache'] = catalogue_cache.get_stats()
+        db.session.remove()
+    return results
+
+
+def hammer_book(book_id, threads, ops_per_thread):
+    """Borrow and return one title from many threads; return (ops, seconds, errors)"""
+    errors = []
+    barrier = threading.Barrier(threads)
+
+    def worker(n):
+        client = app.test_client()
+        barrier.wait()
+        for i in range(ops_per_thread):
+            response = client.post(f'/api/books/{book_id}/borrow', json={'borrower_name': f'Reader {n}'})
+            if response.status_code == 200:
+                response = client.post(f'/api/books/{book_id}/return', json={'condition': 'Good'})
+            if response.status_code not in (200, 400):
+                errors.append(response.get_json())
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * ops_per_thread, time.perf_counter() - start, errors
+
+
+def bench_borrow(args):
+    """Concurrency load test: counts must stay consistent under contention"""
+    results = {'copies': args.copies, 'runs': []}
+    with app.app_context():
+        db.create_all()
+        db.session.add(Book(book_id='HOT-0001', title='Popular Title', author='Someone',
+                            quantity=args.copies, available=args.copies))
+        db.session.commit()
+        db.session.remove()
+
+    for threads in [int(n) for n in args.threads.split(',')]:
+        ops, elapsed, errors = hammer_book('HOT-0001', threads, args.ops)
+        with app.app_context():
+            book = Book.query.filter_by(book_id='HOT-0001').one()
+            open_loans = BorrowRecord.query.filter_by(book_id=book.id, returned=False).count()
+            consistent = 0 <= book.available <= book.quantity and book.available == book.quantity - open_loans
+            db.session.remove()
+        results['runs'].append({
+            'threads': threads,
+            'ops': ops,
+            'ops_per_second': ops / elapsed,
+            'errors': len(errors),
+            'available': book.available,
+            'open_loans': open_loans,
+            'consistent': consistent,
+        })
+        if errors:
+            print(f'{threads} threads: first error {errors[0]}')
+        if not consistent:
+            raise SystemExit(f'Inconsistent counts with {threads} threads: '
+                             f'available={book.available}, open loans={open_loans}')
+    return results
+
+
+def bench_return_fallback(args):
+    """Statement count and time of the "return" search fallback vs. the old N+1 loop"""
+    params = {'intent': 'return', 'title': 'no such title', 'author': None, 'category': None,
+              'search_term': None}
+    with app.app_context():
+        db.create_all()
+        generate_books(args.books)
+        generate_loans(args.loans, args.books)
+        search_index.rebuild()
+        db.session.expunge_all()
+
+        legacy, legacy_statements, legacy_seconds = count_statements(legacy_return_fallback)
+        db.session.expunge_all()
+        books, statements, seconds = count_statements(search_books, params)
+        scoped, scoped_statements, scoped_seconds = count_statements(
+            search_books, dict(params, borrower_id='M-0001'))
+        db.session.remove()
+
+    return {
+        'books': args.books,
+        'open_loans': args.loans,
+        'legacy': {'books': len(legacy), 'statements': legacy_statements, 'seconds': legacy_seconds},
+        'join': {'books': len(books), 'statements': statements, 'seconds': seconds},
+        'join_one_borrower': {'books': len(scoped), 'statements': scoped_statements, 'seconds': scoped_seconds},
+    }
+
+
+
+def open_loan_lookup(loan):
+    """The (book, borrower) lookup a return makes to find the loan it closes"""
+    book_pk, borrower_id = loan
+    return BorrowRecord.query.filter_by(book_id=book_pk, borrower_id=borrower_id, returned=False).order_by(
+        BorrowRecord.id).first()
+
+
+def bench_loans(args):
+    """Return lookup and per-borrower loan listing with and without the borrower_id index"""
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.create_all()
+        generate_books(args.books)
+        generate_loans(args.loans, args.books, returned_fraction=0.5)
+        open_loans = db.session.query(BorrowRecord.book_id, BorrowRecord.borrower_id).filter(
+            BorrowRecord.returned == False).all()
+        loans = rng.sample(open_loans, min(200, len(open_loans)))
+        borrowers = [f'M-{rng.randint(0, 996):04d}' for _ in range(200)]
+        client = app.test_client()
+
+        def list_loans(borrower_id):
+            return client.get(f'/api/borrowers/{borrower_id}/loans?limit=100').get_data()
+
+        results = {'books': args.books, 'loans': args.loans, 'open_loans': len(open_loans)}
+        results['indexed'] = {'return_lookup': time_calls(open_loan_lookup, loans),
+                              'borrower_loans': time_calls(list_loans, borrowers)}
+        index = next(index for index in BorrowRecord.__table__.indexes if index.name == 'ix_borrow_record_borrower_id')
+        index.drop(bind=db.engine)
+        results['without_borrower_index'] = {'return_lookup': time_calls(open_loan_lookup, loans),
+                                             'borrower_loans': time_calls(list_loans, borrowers)}
+        db.session.remove()
+    return results
+
+def legacy_overdue(now):
+    """Overdue loans and fines computed in Python, one record at a time"""
+    fines = {}
+    for record in BorrowRecord.query.filter_by(returned=False).all():
+        if record.due_date < now:
+            key = record.borrower_id or record.borrower_name
+            fines[key] = fines.get(key, 0.0) + record.calculate_fine(now)
+    return fines
+
+
+def bench_overdue(args):
+    """Time the set-based overdue refresh against computing fines record by record"""
+    with app.app_context():
+        db.create_all()
+        generate_books(args.books)
+        generate_loans(args.loans, args.books, returned_fraction=0.5)
+        db.session.remove()
+
+        now = datetime.utcnow()
+        start = time.perf_counter()
+        legacy = legacy_overdue(now)
+        legacy_seconds = time.perf_counter() - start
+        db.session.remove()
+        refresh = refresh_overdue(now)
+        summary = dict(db.session.query(BorrowerFine.borrower_key, BorrowerFine.fine_amount))
+        db.session.remove()
+
+    mismatched = [key for key in legacy.keys() | summary.keys()
+                  if abs(legacy.get(key, 0.0) - summary.get(key, 0.0)) > 1e-6]
+    if mismatched:
+        raise SystemExit(f'Fines differ from the legacy computation for {len(mismatched)} borrowers, '
+                         f'e.g. {mismatched[0]!r}: {legacy.get(mismatched[0])} != {summary.get(mismatched[0])}')
+
+    return {
+        'books': args.books,
+        'loans': args.loans,
+        'legacy': {'borrowers': len(legacy), 'seconds': legacy_seconds},
+        'refresh': refresh,
+    }
+
+
+def legacy_books_json():
+    """Every book as an ORM entity, built into a dict field by field and encoded with json"""
+    return json.dumps([{
+        'book_id': book.book_id,
+        'title': book.title,
+        'author': book.author,
+        'available': book.available,
+        'quantity': book.quantity,
+        'category': book.category,
+        'location': book.location
+    } for book in Book.query.all()])
+
+
+def books_json():
+    """Every book as a row tuple of the listed columns, through the shared serializer"""
+    fields = ('book_id', 'title', 'author', 'available', 'quantity', 'category', 'location')
+    to_dict = row_serializer(fields)
+    rows = db.session.query(Book.id, *[getattr(Book, field) for field in fields]).all()
+    return dumps([to_dict(row) for row in rows])
+
+
+def best_of(fn, runs=3, setup=None):
+    """Fastest of `runs` calls, in seconds, with the last result"""
+    timings = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def bench_serialization(args):
+    """Encode the whole catalogue via ORM entities vs. row tuples, plus gzip and ETag revalidation"""
+    with app.app_context():
+        db.create_all()
+        generate_books(args.books)
+        db.session.remove()
+
+        legacy_seconds, legacy_body = best_of(legacy_books_json, setup=db.session.remove)
+        seconds, body = best_of(books_json, setup=db.session.remove)
+        if json.loads(legacy_body) != json.loads(body):
+            raise SystemExit('Serialized catalogues differ')
+        start = time.perf_counter()
+        compressed = gzip.compress(body, GZIP_LEVEL)
+        gzip_seconds = time.perf_counter() - start
+        db.session.remove()
+
+    client = app.test_client()
+    streamed_seconds, streamed = best_of(
+        lambda: client.get('/api/books', headers={'Accept-Encoding': 'gzip'}, buffered=True))
+    page = client.get('/api/books?limit=1000')
+    not_modified = client.get('/api/books?limit=1000', headers={'If-None-Match': page.headers['ETag']})
+    full_page = run_load(lambda client, rng: client.get('/api/books?limit=1000'), 1, 200)
+
+    return {
+        'books': args.books,
+        'legacy_orm': {'seconds': legacy_seconds, 'bytes': len(legacy_body)},
+        'row_tuples': {'seconds': seconds, 'bytes': len(body)},
+        'gzip': {'seconds': gzip_seconds, 'bytes': len(compressed)},
+        'streamed_gzip': {'seconds': streamed_seconds, 'bytes': len(streamed.data),
+                          'status': streamed.status_code},
+        'page_1000': dict(full_page, bytes=len(page.data)),
+        'page_1000_not_modified': {'status': not_modified.status_code, 'bytes': len(not_modified.data)},
+    }
+
+
+def peak_memory(fn, *args, **kwargs):
+    """Peak Python memory allocated while fn runs, in MiB (tracing makes it several times slower)"""
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def edit_catalogue(source, target, changed, removed, added, seed=4):
+    """Copy a CSV catalogue, retitling `changed` rows, dropping `removed` and appending `added`"""
+    import csv
+    rng = random.Random(seed)
+    with open(source, newline='') as f:
+        rows = list(csv.reader(f))
+    header, rows = rows[0], rows[1:]
+    for row in rng.sample(rows, changed):
+        row[1] += ' (revised)'
+    for row in rng.sample(rows, removed):
+        rows.remove(row)
+    rows += [[f'NEW-{i:07d}', f'New Title {i}', 'Some Author', '', 'Fiction', 'Shelf Z1', 1, 1]
+             for i in range(added)]
+    with open(target, 'w', newline='') as f:
+        csv.writer(f).writerows([header] + rows)
+
+
+def bench_catalogue(args):
+    """Export the catalogue (time, then peak memory of a second run) and sync edited copies back"""
+    directory = tempfile.mkdtemp(prefix='catalogue-')
+    csv_path, xlsx_path, edited_path = (os.path.join(directory, name)
+                                        for name in ('books.csv', 'books.xlsx', 'edited.csv'))
+    results = {'books': args.books, 'loans': args.loans}
+    try:
+        with app.app_context():
+            db.create_all()
+            generate_books(args.books)
+            generate_loans(args.loans, args.books, returned_fraction=0.5)
+            db.session.remove()
+
+            for name, path in (('export_csv', csv_path), ('export_xlsx', xlsx_path)):
+                start = time.perf_counter()
+                count = export_catalogue(path, log=None)
+                results[name] = {'books': count, 'seconds': time.perf_counter() - start,
+                                 'bytes': os.path.getsize(path),
+                                 'peak_mib': peak_memory(export_catalogue, path, log=None)}
+            db.session.remove()
+
+            stats = import_catalogue(csv_path, log=None, delete_missing=True)
+            results['sync_unchanged'] = {'unchanged': stats.unchanged, 'updated': stats.updated,
+                                         'seconds': stats.elapsed}
+            changed = max(1, args.books // 100)
+            edit_catalogue(csv_path, edited_path, changed=changed, removed=changed, added=changed)
+            stats = import_catalogue(edited_path, log=None, delete_missing=True)
+            results['sync_one_percent'] = {
+                'inserted': stats.inserted, 'updated': stats.updated, 'unchanged': stats.unchanged,
+                'deleted': stats.deleted, 'withdrawn': stats.withdrawn, 'retained': stats.retained,
+                'seconds': stats.elapsed,
+            }
+            db.session.remove()
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return results
+
+
+def legacy_similar(book_pk, limit=10):
+    """Books co-borrowed with one book, computed from BorrowRecord on every call"""
+    other = db.aliased(BorrowRecord)
+    return db.session.query(other.book_id, db.func.count(db.func.distinct(other.borrower_id))).join(
+        BorrowRecord, BorrowRecord.borrower_id == other.borrower_id
+    ).filter(
+        BorrowRecord.book_id == book_pk, other.book_id != book_pk
+    ).group_by(other.book_id).order_by(db.func.count(db.func.distinct(other.borrower_id)).desc()).limit(limit).all()
+
+
+def bench_recommendations(args):
+    """Rebuild time, serving latency and per-borrow sync of the co-borrow index vs. live SQL"""
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.create_all()
+        generate_books(args.books)
+        generate_loans(args.loans, args.books, returned_fraction=0.9)
+        db.session.remove()
+
+        start = time.perf_counter()
+        books = recommendations.rebuild()
+        rebuild_seconds = time.perf_counter() - start
+        samples = [rng.randint(1, args.books) for _ in range(20)]
+        legacy = time_calls(legacy_similar, samples)
+        indexed = time_calls(recommendations.similar, samples)
+
+        # One new loan per sync, as after each borrow
+        def borrow_and_sync(i):
+            db.session.execute(BorrowRecord.__table__.insert(), [{
+                'book_id': rng.randint(1, args.books), 'borrower_name': 'Bench',
+                'borrower_id': f'M-{i % 997:04d}', 'due_date': datetime.utcnow()
+            }])
+            db.session.commit()
+            recommendations.sync()
+
+        incremental = time_calls(borrow_and_sync, range(200))
+        db.session.remove()
+
+    scenarios = {
+        'similar': lambda client, rng: client.get(f'/api/books/BEN-{rng.randint(1, args.books):07d}/similar'),
+        'borrower': lambda client, rng: client.get(f'/api/borrowers/M-{rng.randint(0, 996):04d}/recommendations'),
+    }
+    threads = int(args.threads.split(',')[0])
+    return {
+        'books': args.books,
+        'loans': args.loans,
+        'rebuild': {'seconds': rebuild_seconds, 'books_with_neighbours': books},
+        'legacy_sql_similar': legacy,
+        'index_similar': indexed,
+        'borrow_and_sync': incremental,
+        'api': {name: run_load(make_request, threads, args.requests) for name, make_request in scenarios.items()},
+    }
+
+
+
+def insert_out_of_order(table, low_row, high_row, sync):
+    """Insert two rows so the higher id commits first, calling sync() in between and after.
+
+    On SQLite, whose writers are serialised, the ids are given explicitly;
+    elsewhere two real transactions overlap.  Returns (low id, high id).
+    """
+    if db.engine.dialect.name == 'sqlite':
+        low = (db.session.query(db.func.max(table.c.id)).scalar() or 0) + 1
+        db.session.execute(table.insert(), [dict(high_row, id=low + 1)])
+        db.session.commit()
+        sync()
+        db.session.execute(table.insert(), [dict(low_row, id=low)])
+        db.session.commit()
+        sync()
+        return low, low + 1
+    with db.engine.connect() as first:
+        transaction = first.begin()
+        low = first.execute(table.insert().values(**low_row).returning(table.c.id)).scalar()
+        with db.engine.begin() as second:
+            high = second.execute(table.insert().values(**high_row).returning(table.c.id)).scalar()
+        sync()
+        transaction.commit()
+    sync()
+    return low, high
+
+
+def unindexed():
+    """Books and borrow records missing from the search and co-borrow indexes"""
+    books = {id for id, in db.session.query(Book.id)} - set(search_index._docs)
+    loans = [(borrower_id, book_pk) for borrower_id, book_pk in
+             db.session.query(BorrowRecord.borrower_id, BorrowRecord.book_id).filter(
+                 BorrowRecord.borrower_id.isnot(None))
+             if book_pk not in recommendations._borrowers.get(borrower_id, ())]
+    return {'books': len(books), 'loans': len(loans)}
+
+
+def bench_sync(args):
+    """Incremental index syncs when inserts commit out of id order, as on PostgreSQL.
+
+    Books and loans are inserted so that a higher id becomes visible
+    first, then added and borrowed concurrently through the API; fails
+    unless every row ends up in the search and recommendation indexes.
+    """
+    with app.app_context():
+        db.create_all()
+        generate_books(args.books)
+        generate_loans(args.loans, args.books)
+        search_index.rebuild()
+        recommendations.rebuild()
+
+        rounds = []
+        for i in range(args.ops):
+            low, high = insert_out_of_order(
+                Book.__table__,
+                {'book_id': f'ORD-{i:05d}-A', 'title': 'Ordering Check', 'quantity': 1, 'available': 1},
+                {'book_id': f'ORD-{i:05d}-B', 'title': 'Ordering Check', 'quantity': 1, 'available': 1},
+                search_index.sync)
+            loan = {'book_id': low, 'borrower_name': 'Ordering Check', 'due_date': datetime.utcnow()}
+            first, second = insert_out_of_order(
+                BorrowRecord.__table__, dict(loan, borrower_id=f'ORD-{i}'), dict(loan, borrower_id=f'ORD-{i}-B'),
+                recommendations.sync)
+            rounds.append((low, high, first, second))
+        out_of_order = unindexed()
+        db.session.remove()
+
+    def add_or_borrow(client, rng):
+        if rng.random() < 0.5:
+            return client.post('/api/books', json={'title': 'Concurrent Add', 'author': 'Load Test', 'quantity': 1})
+        return client.post(f'/api/books/BEN-{rng.randint(1, args.books):07d}/borrow',
+                           json={'borrower_name': 'Load Test', 'borrower_id': f'M-{rng.randint(0, 996):04d}'})
+
+    threads = max(int(n) for n in args.threads.split(','))
+    load = run_load(add_or_borrow, threads, args.requests)
+    with app.app_context():
+        search_index.sync()
+        recommendations.sync()
+        concurrent = unindexed()
+        db.session.remove()
+
+    results = {
+        'dialect': db.get_engine(app).dialect.name,
+        'out_of_order_rounds': len(rounds),
+        'ids_interleaved': all(low < high and first < second for low, high, first, second in rounds),
+        'missing_after_out_of_order': out_of_order,
+        'concurrent_load': load,
+        'missing_after_concurrent_load': concurrent,
+    }
+    if any(out_of_order.values()) or any(concurrent.values()):
+        print(json.dumps(results, indent=2))
+        raise SystemExit('Rows missing from the in-memory indexes')
+    return results
+
+async def timed_call(call):
+    """Await `call`; return the seconds taken and the exception it raised, if any"""
+    start = time.perf_counter()
+    try:
+        await call
+        error = None
+    except Exception as e:
+        error = e
+    return time.perf_counter() - start, error
+
+
+async def consume(stream):
+    return [chunk async for chunk in stream]
+
+
+async def check_model_client(asynchronous, timeout, threshold=3, reset=0.5, max_in_flight=4):
+    """Drive one ModelClient through failures, an open circuit, a trial call and overload"""
+    hang = timeout * 5
+    slack = timeout / 2 + 0.05
+    model = FaultyModel('hang', hang=hang, asynchronous=asynchronous)
+    client = ModelClient(model, timeout=timeout, max_in_flight=max_in_flight, max_workers=max_in_flight,
+                         breaker=CircuitBreaker(failure_threshold=threshold, reset_timeout=reset))
+    checks = {}
+
+    timeouts = [await timed_call(client.generate('hang')) for _ in range(threshold - 1)]
+    timeouts.append(await timed_call(consume(client.generate_stream('hang'))))
+    checks['hung_calls_time_out'] = all(isinstance(error, asyncio.TimeoutError) for _, error in timeouts)
+    checks['deadline_holds'] = max(seconds for seconds, _ in timeouts) < timeout + slack
+    checks['opens_after_threshold'] = client.breaker.state == 'open'
+
+    calls = model.calls
+    rejected = [await timed_call(client.generate('rejected')) for _ in range(10)]
+    checks['open_circuit_rejects'] = all(isinstance(error, ModelUnavailable) for _, error in rejected)
+    checks['open_circuit_skips_model'] = model.calls == calls
+
+    # Let hung worker threads return before the trial calls
+    await asyncio.sleep(max(reset, hang))
+    checks['half_open_after_reset'] = client.breaker.state == 'half_open'
+    model.mode = 'raise'
+    _, error = await timed_call(client.generate('trial'))
+    checks['failed_trial_reopens'] = isinstance(error, RuntimeError) and client.breaker.state == 'open'
+    await asyncio.sleep(reset)
+    model.mode = 'ok'
+    _, error = await timed_call(client.generate('trial'))
+    checks['successful_trial_closes'] = error is None and client.breaker.state == 'closed'
+
+    # Overload: twice the in-flight limit at once against a hanging model
+    model.mode = 'hang'
+    client.breaker = CircuitBreaker(failure_threshold=1000, reset_timeout=reset)
+    burst = await asyncio.gather(*(timed_call(client.generate('burst')) for _ in range(max_in_flight * 2)))
+    errors = Counter(type(error).__name__ for _, error in burst)
+    checks['overload_rejected'] = errors['ModelUnavailable'] == max_in_flight
+    checks['overload_deadline_holds'] = max(seconds for seconds, _ in burst) < timeout + slack
+    # A worker thread outlives its deadline, and keeps its slot until it returns
+    workers = sum(thread.name.startswith('gemini') and thread.is_alive() for thread in threading.enumerate())
+    _, error = await timed_call(client.generate('after burst'))
+    if asynchronous:
+        checks['slots_free_at_deadline'] = isinstance(error, asyncio.TimeoutError)
+    else:
+        checks['overrunning_threads_hold_slots'] = isinstance(error, ModelUnavailable)
+        checks['threads_within_limit'] = workers <= max_in_flight
+    await asyncio.sleep(hang)
+
+    return {
+        'timeout_ms': timeout * 1000,
+        'max_timed_out_call_ms': max(seconds for seconds, _ in timeouts) * 1000,
+        'max_rejected_call_ms': max(seconds for seconds, _ in rejected) * 1000,
+        'max_overload_call_ms': max(seconds for seconds, _ in burst) * 1000,
+        'overload_errors': dict(errors),
+        'model_worker_threads': workers,
+        'stats': client.get_stats(),
+        'checks': checks,
+    }
+
+
+def bench_model(args):
+    """Deadlines and the circuit breaker of ModelClient with a model that hangs, then fails.
+
+    Runs against the async API and against the sync API on worker threads;
+    fails unless every check holds.
+    """
+    results = {}
+    for api, asynchronous in (('async', True), ('thread', False)):
+        results[api] = asyncio.run(check_model_client(asynchronous, args.model_timeout))
+        failed = [name for name, ok in results[api]['checks'].items() if not ok]
+        print(f'{api:8} {len(results[api]["checks"]) - len(failed)}/{len(results[api]["checks"])} checks passed'
+              + (f', failed: {", ".join(failed)}' if failed else ''))
+        if failed:
+            results['failed'] = True
+    return results
+
+# Code timed by the startup benchmark, each in a fresh interpreter
+STARTUP_TARGETS = {
+    'import_app': 'import app',
+    'create_app': 'import app; app.create_app()',
+    'import_init_db': 'import init_db',
+}
+
+# Modules that must only be imported when first used
+LAZY_MODULES = ('google.generativeai', 'pandas', 'openpyxl', 'numpy', 'scipy')
+
+
+def parse_importtime(stderr):
+    """Return {module: (self seconds, cumulative seconds, depth)} from python -X importtime output"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6, depth)
+    return modules
+
+
+def bench_startup(args):
+    """Interpreter startup and import time of the app and CLI entry points"""
+    results = {}
+    for name, code in STARTUP_TARGETS.items():
+        wall, imports = [], []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                       capture_output=True, text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+            wall.append(time.perf_counter() - start)
+            if completed.returncode:
+                raise SystemExit(f'{code!r} failed:\n{completed.stderr[-2000:]}')
+            modules = parse_importtime(completed.stderr)
+            imports.append(sum(self_seconds for self_seconds, _, _ in modules.values()))
+        top_level = sorted(((cumulative, module) for module, (_, cumulative, depth) in modules.items()
+                            if depth == 1), reverse=True)[:8]
+        loaded = [module for module in LAZY_MODULES if module in modules]
+        results[name] = {
+            'wall_ms': statistics.median(wall) * 1000,
+            'import_ms': statistics.median(imports) * 1000,
+            'slowest_imports': {module: round(cumulative * 1000, 1) for cumulative, module in top_level},
+            'lazy_modules_loaded': loaded,
+        }
+        print(f'{name:16} {results[name]["wall_ms"]:7.0f}ms wall, {results[name]["import_ms"]:7.0f}ms importing'
+              + (f', eagerly loaded: {", ".join(loaded)}' if loaded else ''))
+    eager = sorted({module for result in results.values() for module in result['lazy_modules_loaded']})
+    if eager:
+        print(f'Modules that should load lazily were imported at startup: {", ".join(eager)}')
+        results['failed'] = True
+    return results
+
+
+def api_scenarios(book_count):
+    """Requests to drive against each endpoint, keyed by scenario name"""
+    def book_id(rng):
+        return f'BEN-{rng.randint(1, book_count):07d}'
+
+    local_queries = [f'{category.lower()} books' for category in CATEGORIES]
+    local_queries += [f'books by {name}' for name in LAST_NAMES]
+    model_queries = [f'something about {word} and {other}' for word in WORDS[:8] for other in WORDS[8:16]]
+
+    def borrow_and_return(client, rng):
+        target = book_id(rng)
+        response = client.post(f'/api/books/{target}/borrow', json={'borrower_name': 'Load Test'})
+        if response.status_code == 200:
+            response = client.post(f'/api/books/{target}/return', json={'condition': 'Good'})
+        return response
+
+    return {
+        'query_local': lambda client, rng: client.post('/api/query', json={'query': rng.choice(local_queries)}),
+        'query_model': lambda client, rng: client.post('/api/query', json={'query': rng.choice(model_queries)}),
+        'books_page': lambda client, rng: client.get(
+            f'/api/books?limit=100&cursor={rng.randint(0, max(0, book_count - 100))}'),
+        'books_filtered': lambda client, rng: client.get(
+            f'/api/books?limit=100&available=true&category={rng.choice(CATEGORIES)}'),
+        'history_page': lambda client, rng: client.get(f'/api/books/{book_id(rng)}/history?limit=50'),
+        'history_summary': lambda client, rng: client.get(f'/api/books/{book_id(rng)}/history?summary=true'),
+        'borrow_return': borrow_and_return,
+        'overdue_page': lambda client, rng: client.get('/api/overdue?limit=100'),
+        'fines_page': lambda client, rng: client.get('/api/fines?limit=100'),
+        'borrower_loans': lambda client, rng: client.get(f'/api/borrowers/M-{rng.randint(0, 996):04d}/loans?limit=100'),
+    }
+
+
+def bench_api(args):
+    """Latency percentiles and throughput for each endpoint under threaded load"""
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        generate_books(args.books)
+        generate_loans(args.loans, args.books, returned_fraction=0.9)
+        print(f'Generated {args.books} books and {args.loans} loans in {time.perf_counter() - start:.2f}s')
+        search_index.rebuild()
+        refresh_overdue()
+        db.session.remove()
+
+    scenarios = api_scenarios(args.books)
+    selected = args.scenarios.split(',') if args.scenarios else list(scenarios)
+    results = {'books': args.books, 'loans': args.loans, 'model_latency_ms': args.model_latency * 1000,
+               'scenarios': {}}
+    for name in selected:
+        results['scenarios'][name] = {}
+        for threads in [int(n) for n in args.threads.split(',')]:
+            run = run_load(scenarios[name], threads, args.requests)
+            results['scenarios'][name][f'{threads}_threads'] = run
+            print(f'{name:16} {threads:3} threads: {run["requests_per_second"]:8.1f} req/s, '
+                  f'p50 {run["p50_ms"]:.2f}ms, p95 {run["p95_ms"]:.2f}ms, errors {run["errors"]}')
+    return results
+
+
+def run_metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    with app.app_context():
+        url = db.engine.url
+    return {
+        'benchmark': args.benchmark,
+        'database': url.get_backend_name(),
+        'sqlite_pragmas': sqlite_pragmas() if url.get_backend_name() == 'sqlite' else None,
+        'engine_options': {key: value for key, value in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items()
+                           if isinstance(value, (int, float, str, bool))},
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'args': vars(args),
+    }
+
+
+def flatten(results, prefix=''):
+    """Yield (dotted key, value) for every number in a nested result"""
+    if isinstance(results, dict):
+        for key, value in results.items():
+            yield from flatten(value, f'{prefix}{key}.')
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        yield prefix[:-1], results
+
+
+def compare(baseline, current):
+    """Print timing and throughput changes relative to a saved run"""
+    before = dict(flatten(baseline))
+    for key, value in flatten(current):
+        if not key.endswith(('_ms', 'per_second', 'seconds')) or not before.get(key):
+            continue
+        change = (value - before[key]) / before[key] * 100
+        print(f'{key:60} {before[key]:12.3f} -> {value:12.3f} ({change:+.1f}%)')
+
+
+BENCHMARKS = {
+    'api': bench_api,
+    'search': bench_search,
+    'borrow': bench_borrow,
+    'return-fallback': bench_return_fallback,
+    'loans': bench_loans,
+    'overdue': bench_overdue,
+    'startup': bench_startup,
+    'serialization': bench_serialization,
+    'catalogue': bench_catalogue,
+    'recommendations': bench_recommendations,
+    'sync': bench_sync,
+    'model': bench_model,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--threads', default='1,4,16', help='comma-separated thread counts')
+    parser.add_argument('--ops', type=int, default=100, help='borrow/return cycles per thread')
+    parser.add_argument('--copies', type=int, default=5)
+    parser.add_argument('--loans', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario and thread count')
+    parser.add_argument('--scenarios', help='comma-separated api scenarios (default: all)')
+    parser.add_argument('--model-latency', type=float, default=0.05, help='seconds per fake model call')
+    parser.add_argument('--model-timeout', type=float, default=0.2, help='model deadline for the model benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--runs', type=int, default=5, help='interpreter launches per startup target')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare against')
+    parser.add_argument('--database-url', help='run against this empty database (e.g. PostgreSQL) '
+                                               'instead of a temporary SQLite file; its tables are dropped afterwards')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    library_agent.model = FakeModel(args.model_latency)
+    library_agent.cache = QueryCache()
+
+    if args.database_url:
+        path = None
+        use_database(args.database_url)
+    else:
+        path = use_temp_database()
+    try:
+        results = BENCHMARKS[args.benchmark](args)
+    finally:
+        with app.app_context():
+            db.session.remove()
+            if not path:
+                db.drop_all()
+            # Close pooled connections so SQLite checkpoints and drops -wal/-shm
+            db.get_engine(app).dispose()
+        if path:
+            for name in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    output = {'metadata': run_metadata(args), 'results': results}
+    print(json.dumps(output, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['results'], results)
+    if results.get('failed'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from database import MAX_WRITE_RETRIES, RETRY_BASE_DELAY, is_busy_error
+from models import db, Book, BookIdSequence
+
+
+def format_book_id(year: int, number: int) -> str:
+    return f'LIB-{year}-{str(number).zfill(4)}'
+
+
+class BookIdAllocator:
+    """Hands out LIB-YYYY-NNNN ids from a per-year sequence row.
+
+    A block of numbers is reserved with one atomic UPDATE in its own
+    transaction, so concurrent requests and workers never receive the same
+    id.  With block_size > 1 each process reserves numbers in advance and
+    serves them from memory; unused numbers are lost on restart, leaving
+    gaps but never duplicates.
+    """
+
+    def __init__(self, block_size: int = 1):
+        self.block_size = max(1, block_size)
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self._pid = os.getpid()
+
+    def allocate(self, count: int = 1, year: Optional[int] = None) -> List[str]:
+        year = year or datetime.utcnow().year
+        with self._lock:
+            if self._pid != os.getpid():
+                # Blocks reserved by the parent process must not be reused after a fork
+                self._blocks.clear()
+                self._pid = os.getpid()
+
+            next_number, end = self._blocks.get(year, (0, 0))
+            numbers = list(range(next_number, min(end, next_number + count)))
+            if len(numbers) < count:
+                needed = count - len(numbers)
+                reserved = max(needed, self.block_size)
+                start = self._reserve(year, reserved)
+                numbers.extend(range(start, start + needed))
+                next_number, end = start + needed, start + reserved
+            else:
+                next_number += count
+            self._blocks[year] = (next_number, end)
+        return [format_book_id(year, number) for number in numbers]
+
+    def _reserve(self, year: int, count: int) -> int:
+        """Atomically reserve `count` numbers for `year` and return the first"""
+        table = BookIdSequence.__table__
+        for attempt in range(MAX_WRITE_RETRIES + 1):
+            try:
+                with db.engine.begin() as connection:
+                    updated = connection.execute(
+                        table.update()
+                        .where(table.c.year == year)
+                        .values(next_value=table.c.next_value + count)
+                    ).rowcount
+                    if not updated:
+                        first = self._highest_existing(connection, year) + 1
+                        connection.execute(table.insert().values(year=year, next_value=first + count))
+                        return first
+                    next_value = connection.execute(
+                        select(table.c.next_value).where(table.c.year == year)
+                    ).scalar_one()
+                    return next_value - count
+            except IntegrityError:
+                # Another worker created this year's row first; increment it instead
+                continue
+            except OperationalError as e:
+                if attempt == MAX_WRITE_RETRIES or not is_busy_error(e):
+                    raise
+                time.sleep(RETRY_BASE_DELAY * (2 ** attempt))
+        raise RuntimeError(f'Could not reserve book ids for {year}')
+
+    @staticmethod
+    def _highest_existing(connection, year: int) -> int:
+        """Highest number already used for `year`, so the sequence continues from existing books"""
+        prefix = f'LIB-{year}-'
+        book_ids = connection.execute(
+            select(Book.book_id).where(Book.book_id.like(f'{prefix}%'))
+        ).scalars()
+        highest = 0
+        for book_id in book_ids:
+            suffix = book_id[len(prefix):]
+            if suffix.isdigit():
+                highest = max(highest, int(suffix))
+        return highest
+
+
+book_id_allocator = BookIdAllocator(block_size=int(os.getenv('BOOK_ID_BLOCK_SIZE', 1)))
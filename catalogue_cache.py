@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from models import Book
+from search_index import CASCADE, tokenize
+
+# Columns kept for each cached book; rows are immutable snapshots that
+# the API serialises (see serialization.py)
+CATALOGUE_COLUMNS = (Book.id, Book.book_id, Book.title, Book.author, Book.isbn,
+                     Book.quantity, Book.available, Book.category, Book.location)
+CachedBook = namedtuple('CachedBook', [column.key for column in CATALOGUE_COLUMNS])
+
+
+class CatalogueCache:
+    """Read-through cache of book rows and search results.
+
+    Rows are keyed by primary key (with a book_id -> id map so write paths
+    can invalidate by public id), and search results by the normalised
+    title/category/author/search term of the query.  Both maps are LRU with
+    a time-to-live, which also bounds how stale a row can get when another
+    process or a catalogue import changes it.  Results with more than
+    `max_result` books (whole categories, say) are not cached, so a few
+    broad listings cannot flush the rows that availability checks reuse.
+
+    Writers call invalidate_book() after a borrow or return commits and
+    invalidate_lookups() after books are added.  Readers take a
+    generation() token before going to the database and pass it to put_*,
+    so a row read before a concurrent write is never cached after it.
+    """
+
+    def __init__(self, max_books: int = 10000, max_lookups: int = 1000, max_result: int = 200,
+                 ttl: float = 30):
+        self.max_books = max_books
+        self.max_lookups = max_lookups
+        self.max_result = max_result
+        self.ttl = ttl
+        self._books = OrderedDict()
+        self._ids = {}
+        self._lookups = OrderedDict()
+        self._book_generation = 0
+        self._lookup_generation = 0
+        self._lock = threading.Lock()
+        self._stats = Counter(hits=0, misses=0, lookup_hits=0, lookup_misses=0,
+                              expired=0, evictions=0, invalidations=0)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_books > 0
+
+    def cacheable(self, count: int) -> bool:
+        return self.enabled and count <= self.max_result
+
+    @staticmethod
+    def lookup_key(query_params: Dict, fuzzy: bool = True) -> Tuple:
+        return tuple(' '.join(tokenize(query_params.get(key))) for key, _ in CASCADE) + (fuzzy,)
+
+    def generation(self) -> Tuple[int, int]:
+        with self._lock:
+            return self._book_generation, self._lookup_generation
+
+    def get_books(self, ids: Iterable[int]) -> Tuple[Dict[int, CachedBook], List[int]]:
+        """Return ({id: cached row}, ids that have to be loaded)"""
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for book_id in ids:
+                entry = self._books.get(book_id)
+                if entry is not None and entry[1] <= now:
+                    self._drop(entry[0])
+                    self._stats['expired'] += 1
+                    entry = None
+                if entry is None:
+                    missing.append(book_id)
+                    continue
+                self._books.move_to_end(book_id)
+                found[book_id] = entry[0]
+            self._stats['hits'] += len(found)
+            self._stats['misses'] += len(missing)
+        return found, missing
+
+    def put_books(self, rows: Iterable[CachedBook], generation: Tuple[int, int]):
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            if generation[0] != self._book_generation:
+                return
+            for row in rows:
+                self._books[row.id] = (row, expires_at)
+                self._books.move_to_end(row.id)
+                self._ids[row.book_id] = row.id
+            while len(self._books) > self.max_books:
+                row, _ = self._books.popitem(last=False)[1]
+                self._ids.pop(row.book_id, None)
+                self._stats['evictions'] += 1
+
+    def get_lookup(self, query_params: Dict, fuzzy: bool = True) -> Optional[List[int]]:
+        key = self.lookup_key(query_params, fuzzy)
+        with self._lock:
+            entry = self._lookups.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._lookups[key]
+                self._stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self._stats['lookup_misses'] += 1
+                return None
+            self._lookups.move_to_end(key)
+            self._stats['lookup_hits'] += 1
+            return entry[0]
+
+    def put_lookup(self, query_params: Dict, ids: List[int], generation: Tuple[int, int],
+                   fuzzy: bool = True):
+        if not self.cacheable(len(ids)):
+            return
+        key = self.lookup_key(query_params, fuzzy)
+        with self._lock:
+            if generation[1] != self._lookup_generation:
+                return
+            self._lookups[key] = (list(ids), time.monotonic() + self.ttl)
+            self._lookups.move_to_end(key)
+            while len(self._lookups) > self.max_lookups:
+                self._lookups.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def _drop(self, row: CachedBook):
+        self._books.pop(row.id, None)
+        self._ids.pop(row.book_id, None)
+
+    def invalidate_book(self, id: Optional[int] = None, book_id: Optional[str] = None):
+        """Forget one book's row, by primary key or public book_id"""
+        with self._lock:
+            self._book_generation += 1
+            if id is None:
+                id = self._ids.get(book_id)
+            entry = self._books.get(id)
+            if entry is not None:
+                self._drop(entry[0])
+                self._stats['invalidations'] += 1
+
+    def invalidate_lookups(self):
+        """Forget cached search results, e.g. after books are added"""
+        with self._lock:
+            self._lookup_generation += 1
+            self._stats['invalidations'] += len(self._lookups)
+            self._lookups.clear()
+
+    def clear(self):
+        with self._lock:
+            self._book_generation += 1
+            self._lookup_generation += 1
+            self._books.clear()
+            self._ids.clear()
+            self._lookups.clear()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._books)
+            stats['lookups'] = len(self._lookups)
+        reads = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / reads if reads else 0.0
+        lookups = stats['lookup_hits'] + stats['lookup_misses']
+        stats['lookup_hit_rate'] = stats['lookup_hits'] / lookups if lookups else 0.0
+        return stats
+
+    @classmethod
+    def from_env(cls) -> 'CatalogueCache':
+        return cls(
+            max_books=int(os.getenv('CATALOGUE_CACHE_SIZE', 10000)),
+            max_lookups=int(os.getenv('CATALOGUE_CACHE_LOOKUPS', 1000)),
+            max_result=int(os.getenv('CATALOGUE_CACHE_MAX_RESULT', 200)),
+            ttl=float(os.getenv('CATALOGUE_CACHE_TTL', 30))
+        )
+
+
+catalogue_cache = CatalogueCache.from_env()
@@ -0,0 +1,353 @@
+import csv
+import hashlib
+import os
+import time
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Set
+
+from sqlalchemy import bindparam
+
+from catalogue_cache import catalogue_cache
+from models import db, Book, BorrowRecord, CatalogueVersion
+from serialization import iter_rows_by_id
+
+REQUIRED_COLUMNS = ['book_id', 'title', 'author', 'category', 'location', 'quantity', 'available']
+
+# Columns compared to decide whether a book changed; availability follows
+# loans in the database, so the sheet's value is not compared
+SYNC_COLUMNS = ('title', 'author', 'isbn', 'category', 'location', 'quantity')
+
+EXPORT_COLUMNS = ('book_id', 'title', 'author', 'isbn', 'category', 'location', 'quantity', 'available')
+EXPORT_COLUMN_WIDTHS = {'book_id': 16, 'title': 50, 'author': 30, 'isbn': 16, 'category': 20, 'location': 20}
+
+# Only the first few validation errors are kept for reporting
+MAX_REPORTED_ERRORS = 100
+
+# SQLite limits the number of bound parameters per statement
+LOOKUP_CHUNK_SIZE = 500
+
+
+class ImportStats:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.withdrawn = 0
+        self.retained = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def processed(self):
+        return self.inserted + self.updated + self.unchanged + self.skipped
+
+    @property
+    def rows_per_second(self):
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        removed = ''
+        if self.deleted or self.withdrawn or self.retained:
+            removed = (f", {self.deleted} deleted, {self.withdrawn} withdrawn, "
+                       f"{self.retained} kept with copies on loan")
+        return (f"{self.inserted} inserted, {self.updated} updated, {self.unchanged} unchanged, "
+                f"{self.skipped} skipped{removed} in {self.elapsed:.2f}s ({self.rows_per_second:,.0f} rows/s)")
+
+
+def iter_excel_rows(path: str) -> Iterator[Dict]:
+    """Stream rows from the first sheet of a workbook without loading it into memory"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(name).strip() if name is not None else '' for name in header]
+        for values in rows:
+            if values is None or all(value is None for value in values):
+                continue
+            yield dict(zip(columns, values))
+    finally:
+        workbook.close()
+
+
+def iter_csv_rows(path: str) -> Iterator[Dict]:
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield {(key or '').strip(): value for key, value in row.items()}
+
+
+def iter_rows(path: str) -> Iterator[Dict]:
+    if os.path.splitext(path)[1].lower() == '.csv':
+        return iter_csv_rows(path)
+    return iter_excel_rows(path)
+
+
+def check_columns(row: Dict):
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in row]
+    if missing_columns:
+        raise ValueError(f"Catalogue file is missing required columns: {', '.join(missing_columns)}")
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def validate_row(row: Dict) -> Dict:
+    """Return a row ready for insertion, or raise ValueError"""
+    book_id = _text(row.get('book_id'))
+    title = _text(row.get('title'))
+    if not book_id:
+        raise ValueError('missing book_id')
+    if not title:
+        raise ValueError(f'{book_id}: missing title')
+    try:
+        quantity = int(float(row.get('quantity')))
+        available = int(float(row.get('available')))
+    except (TypeError, ValueError):
+        raise ValueError(f'{book_id}: quantity and available must be numbers')
+    if quantity < 0 or not 0 <= available <= quantity:
+        raise ValueError(f'{book_id}: available must be between 0 and quantity')
+    return {
+        'book_id': book_id,
+        'title': title,
+        'author': _text(row.get('author')),
+        'isbn': _text(row.get('isbn')),
+        'category': _text(row.get('category')),
+        'location': _text(row.get('location')),
+        'quantity': quantity,
+        'available': available,
+    }
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def row_hash(row) -> bytes:
+    """Digest of a book's SYNC_COLUMNS, from a validated row or a database row mapping"""
+    values = '\x1f'.join('' if row[column] is None else str(row[column]) for column in SYNC_COLUMNS)
+    return hashlib.blake2b(values.encode(), digest_size=16).digest()
+
+
+def existing_books(book_ids: List[str]) -> Dict[str, tuple]:
+    """Map catalogue book_id -> (current quantity, row_hash) for ids already in the database"""
+    existing = {}
+    columns = [getattr(Book, column) for column in SYNC_COLUMNS]
+    for chunk in chunked(book_ids, LOOKUP_CHUNK_SIZE):
+        for row in db.session.query(Book.book_id, *columns).filter(Book.book_id.in_(chunk)):
+            existing[row.book_id] = (row.quantity, row_hash(row._mapping))
+    return existing
+
+
+def upsert_chunk(rows: List[Dict], stats: ImportStats):
+    """Insert new books and update changed ones in one transaction"""
+    # Later rows win when a chunk repeats a book_id
+    by_id = {row['book_id']: row for row in rows}
+    existing = existing_books(list(by_id))
+
+    inserts = [row for book_id, row in by_id.items() if book_id not in existing]
+    updates = []
+    for book_id, row in by_id.items():
+        if book_id not in existing:
+            continue
+        quantity, digest = existing[book_id]
+        if digest == row_hash(row):
+            stats.unchanged += 1
+            continue
+        # Keep copies that are out on loan: shift availability by the
+        # change in quantity rather than trusting the sheet's column
+        updates.append(dict(row, b_book_id=book_id, delta=row['quantity'] - (quantity or 0)))
+
+    table = Book.__table__
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    if updates:
+        db.session.execute(
+            table.update()
+            .where(table.c.book_id == bindparam('b_book_id'))
+            .values(
+                title=bindparam('title'),
+                author=bindparam('author'),
+                isbn=bindparam('isbn'),
+                category=bindparam('category'),
+                location=bindparam('location'),
+                quantity=bindparam('quantity'),
+                available=db.case(
+                    (table.c.available + bindparam('delta') < 0, 0),
+                    else_=table.c.available + bindparam('delta')
+                ),
+            ),
+            updates
+        )
+        CatalogueVersion.bump()
+    db.session.commit()
+    stats.inserted += len(inserts)
+    stats.updated += len(updates)
+    stats.skipped += len(rows) - len(by_id)
+
+
+def remove_missing(seen: Set[str], stats: ImportStats):
+    """Remove books whose book_id is not in `seen`, one batch of the table at a time.
+
+    Books that were never borrowed are deleted.  Borrowed books keep their
+    row so loan history stays intact: they are withdrawn (no copies) unless
+    copies are still on loan, in which case they are left for now.
+    """
+    table = Book.__table__
+    last_id = 0
+    while True:
+        rows = db.session.query(Book.id, Book.book_id, Book.quantity).filter(
+            Book.id > last_id
+        ).order_by(Book.id).limit(LOOKUP_CHUNK_SIZE).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        missing = {id: quantity for id, book_id, quantity in rows if book_id not in seen}
+        if not missing:
+            continue
+        # book id -> whether any of its loans is still open
+        borrowed = dict(db.session.query(
+            BorrowRecord.book_id,
+            db.func.max(db.case((BorrowRecord.returned == False, 1), else_=0))
+        ).filter(BorrowRecord.book_id.in_(list(missing))).group_by(BorrowRecord.book_id).all())
+        deletes = [id for id in missing if id not in borrowed]
+        withdrawals = [id for id, open_loans in borrowed.items() if not open_loans and missing[id]]
+        if deletes:
+            db.session.execute(table.delete().where(table.c.id.in_(deletes)))
+        if withdrawals:
+            db.session.execute(table.update().where(table.c.id.in_(withdrawals)).values(quantity=0, available=0))
+        if deletes or withdrawals:
+            CatalogueVersion.bump()
+        db.session.commit()
+        stats.deleted += len(deletes)
+        stats.withdrawn += len(withdrawals)
+        stats.retained += sum(1 for open_loans in borrowed.values() if open_loans)
+
+
+def import_rows(rows: Iterable[Dict], batch_size: int = 1000, log=print,
+                delete_missing: bool = False) -> ImportStats:
+    """Validate and upsert catalogue rows by book_id in batched transactions.
+
+    Rows whose catalogue columns match the database are skipped.  With
+    delete_missing=True the file is treated as the whole catalogue and books
+    it does not list are removed afterwards (see remove_missing).
+    """
+    stats = ImportStats()
+    seen = set() if delete_missing else None
+    columns_checked = False
+    for chunk in chunked(rows, batch_size):
+        if not columns_checked:
+            check_columns(chunk[0])
+            columns_checked = True
+        valid = []
+        for row in chunk:
+            if seen is not None:
+                # Invalid rows still count as listed, so they are never deleted
+                seen.add(_text(row.get('book_id')))
+            try:
+                valid.append(validate_row(row))
+            except ValueError as e:
+                stats.skipped += 1
+                if len(stats.errors) < MAX_REPORTED_ERRORS:
+                    stats.errors.append(str(e))
+        if valid:
+            try:
+                upsert_chunk(valid, stats)
+            except Exception:
+                db.session.rollback()
+                raise
+        stats.elapsed = time.perf_counter() - stats.started
+        if log:
+            log(f"Imported {stats.processed} rows ({stats.rows_per_second:,.0f} rows/s)")
+    if seen is not None:
+        if not columns_checked:
+            raise ValueError('Catalogue file has no rows; refusing to delete every book')
+        try:
+            remove_missing(seen, stats)
+        except Exception:
+            db.session.rollback()
+            raise
+    catalogue_cache.clear()
+    stats.elapsed = time.perf_counter() - stats.started
+    return stats
+
+
+def import_catalogue(path: str, batch_size: int = 1000, log=print,
+                     delete_missing: bool = False) -> ImportStats:
+    """Stream an .xlsx or .csv catalogue into the database"""
+    return import_rows(iter_rows(path), batch_size=batch_size, log=log, delete_missing=delete_missing)
+
+
+def iter_catalogue(batch_size: int = 1000) -> Iterator[tuple]:
+    """Yield EXPORT_COLUMNS of every book in id order, reading batch_size rows at a time"""
+    query = db.session.query(Book.id, *[getattr(Book, column) for column in EXPORT_COLUMNS])
+    for row in iter_rows_by_id(query, Book.id, batch_size=batch_size):
+        yield tuple(row[1:])
+
+
+def write_excel_rows(path: str, rows: Iterable[tuple]):
+    """Write a workbook row by row with openpyxl's write-only mode, in constant memory"""
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Books')
+    for index, column in enumerate(EXPORT_COLUMNS, start=1):
+        if column in EXPORT_COLUMN_WIDTHS:
+            worksheet.column_dimensions[get_column_letter(index)].width = EXPORT_COLUMN_WIDTHS[column]
+    worksheet.append(EXPORT_COLUMNS)
+    for row in rows:
+        worksheet.append(row)
+    workbook.save(path)
+
+
+def write_csv_rows(path: str, rows: Iterable[tuple]):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        writer.writerows(rows)
+
+
+def export_catalogue(path: str, batch_size: int = 1000, log=print) -> int:
+    """Write every book to an .xlsx or .csv file that import_catalogue can read back.
+
+    Rows are streamed from the database, and the file is written next to
+    `path` and moved into place once complete.  Returns the number of books.
+    """
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    base, extension = os.path.splitext(path)
+    partial = f'{base}.partial{extension}'
+    writer = write_csv_rows if extension.lower() == '.csv' else write_excel_rows
+    try:
+        writer(partial, counted(iter_catalogue(batch_size)))
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    if log:
+        log(f"Exported {count} books to {path}")
+    return count
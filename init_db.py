@@ -1,8 +1,10 @@
 from app import app, db
 from models import Book
-import pandas as pd
+from catalogue_import import export_catalogue, import_catalogue, import_rows
+from migrations import upgrade
+import argparse
 import os
-from datetime import datetime
+import sys
 
 def create_sample_books():
     """Create a list of sample books"""
@@ -54,102 +56,71 @@ def create_sample_books():
         )
     ]
 
-def save_books_to_excel(books, excel_path):
-    """Save books to Excel file with proper formatting"""
-    try:
-        # Create data directory if it doesn't exist
-        os.makedirs(os.path.dirname(excel_path), exist_ok=True)
-        
-        # Convert books to DataFrame
-        df = pd.DataFrame([{
-            'book_id': book.book_id,
-            'title': book.title,
-            'author': book.author,
-            'category': book.category,
-            'location': book.location,
-            'quantity': book.quantity,
-            'available': book.available,
-            'created_at': datetime.utcnow().isoformat()
-        } for book in books])
-        
-        print("Creating new Excel template...")
-        # Save to Excel with proper formatting
-        with pd.ExcelWriter(excel_path, engine='openpyxl', mode='w') as writer:
-            df.to_excel(writer, index=False, sheet_name='Books')
-            # Auto-adjust columns' width
-            worksheet = writer.sheets['Books']
-            for idx, col in enumerate(df.columns):
-                max_length = max(
-                    df[col].astype(str).apply(len).max(),
-                    len(col)
-                )
-                worksheet.column_dimensions[chr(65 + idx)].width = max_length + 2
-        
-        print(f"Excel template created at: {excel_path}")
-        return True
-    except Exception as e:
-        print(f"Error saving Excel file: {str(e)}")
-        return False
+def book_to_row(book):
+    return {
+        'book_id': book.book_id,
+        'title': book.title,
+        'author': book.author,
+        'category': book.category,
+        'location': book.location,
+        'quantity': book.quantity,
+        'available': book.available
+    }
 
-def init_db():
-    """Initialize the database with books from Excel or create sample books"""
+def catalogue_is_empty():
+    return db.session.query(Book.id).first() is None
+
+DEFAULT_CATALOGUE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'books.xlsx')
+
+def init_db(excel_path=None, reset=False, batch_size=1000, sync=False):
+    """Load the catalogue from Excel/CSV into the database, or create sample books.
+
+    Books are upserted by book_id so borrow history is kept, and rows that
+    have not changed are skipped; with sync=True books missing from the
+    file are removed too. Sample books are only added to an empty
+    catalogue; otherwise a file that cannot be read raises. Pass
+    reset=True to drop and recreate all tables first.
+    """
+    excel_path = excel_path or DEFAULT_CATALOGUE_PATH
     with app.app_context():
         try:
-            # Drop all tables and create new ones
-            print("Dropping existing tables...")
-            db.drop_all()
-            print("Creating new tables...")
-            db.create_all()
-            
-            # Read books from Excel file
-            excel_path = os.path.join(os.path.dirname(__file__), 'data', 'books.xlsx')
-            books_to_add = []
+            if reset:
+                # Drop all tables and create new ones
+                print("Dropping existing tables...")
+                db.drop_all()
+            print("Creating tables...")
+            upgrade()
             
             if os.path.exists(excel_path):
                 try:
-                    print("Reading existing Excel file...")
-                    df = pd.read_excel(excel_path, engine='openpyxl')
-                    
-                    # Validate required columns
-                    required_columns = ['book_id', 'title', 'author', 'category', 'location', 'quantity', 'available']
-                    missing_columns = [col for col in required_columns if col not in df.columns]
-                    
-                    if missing_columns:
-                        raise ValueError(f"Excel file is missing required columns: {', '.join(missing_columns)}")
-                    
-                    # Add each book from the Excel file
-                    for _, row in df.iterrows():
-                        book = Book(
-                            book_id=str(row['book_id']),
-                            title=row['title'],
-                            author=row['author'],
-                            category=row['category'],
-                            location=row['location'],
-                            quantity=int(row['quantity']),
-                            available=int(row['available'])
-                        )
-                        books_to_add.append(book)
-                    
-                    print("Books loaded successfully from Excel!")
-                    
+                    print(f"Reading {excel_path}...")
+                    stats = import_catalogue(excel_path, batch_size=batch_size, delete_missing=sync)
+                    for error in stats.errors:
+                        print(f"Skipped row: {error}")
+                    print(f"Books loaded successfully: {stats}")
+                    return stats
                 except Exception as e:
-                    print(f"Error reading Excel file: {str(e)}")
-                    print("Falling back to sample books...")
-                    books_to_add = create_sample_books()
+                    db.session.rollback()
+                    print(f"Error reading catalogue file: {str(e)}")
+                    # Sample books must never be mixed into a real catalogue,
+                    # including one this import committed part of
+                    if not catalogue_is_empty():
+                        raise
+                    print("Catalogue is empty, falling back to sample books...")
+            elif not catalogue_is_empty():
+                print("Excel file not found and the catalogue already has books; nothing to load.")
+                return None
             else:
                 print("Excel file not found. Creating sample books...")
-                books_to_add = create_sample_books()
-            
-            # Add books to database
-            for book in books_to_add:
-                db.session.add(book)
             
-            db.session.commit()
-            print(f"Added {len(books_to_add)} books to database")
+            sample_books = create_sample_books()
+            stats = import_rows([book_to_row(book) for book in sample_books], batch_size=batch_size)
+            print(f"Added sample books: {stats}")
             
-            # If we used sample books or had to recreate the Excel file, save it
-            if not os.path.exists(excel_path) or len(books_to_add) == len(create_sample_books()):
-                save_books_to_excel(books_to_add, excel_path)
+            # Save the sample catalogue so it can be edited and reloaded
+            if not os.path.exists(excel_path):
+                export_catalogue(excel_path, batch_size=batch_size)
+            return stats
             
         except Exception as e:
             print(f"Error initializing database: {str(e)}")
@@ -157,4 +128,21 @@ def init_db():
             raise e
 
 if __name__ == '__main__':
-    init_db()
+    parser = argparse.ArgumentParser(description='Load the book catalogue into the database')
+    parser.add_argument('path', nargs='?', help='.xlsx or .csv catalogue (default: data/books.xlsx)')
+    parser.add_argument('--reset', action='store_true', help='drop all tables, including borrow records, first')
+    parser.add_argument('--sync', action='store_true',
+                        help='also remove books the file does not list (borrowed books are kept)')
+    parser.add_argument('--export', action='store_true',
+                        help='write the database catalogue to the file instead of loading it')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    if args.export:
+        with app.app_context():
+            export_catalogue(args.path or DEFAULT_CATALOGUE_PATH, batch_size=args.batch_size)
+    else:
+        try:
+            init_db(args.path, reset=args.reset, batch_size=args.batch_size, sync=args.sync)
+        except Exception:
+            # init_db has already reported the error
+            sys.exit(1)
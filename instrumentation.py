@@ -0,0 +1,205 @@
+"""Lightweight timing spans and Prometheus-text metrics.
+
+Spans time a block of code into a histogram labelled with the span name,
+and, when SERVER_TIMING_ENABLED is set, add their duration to the current
+response's Server-Timing header.  With METRICS_ENABLED=0, span() returns
+a shared no-op object, so instrumented code costs one attribute check.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Thread-safe registry of labelled histograms and counters"""
+
+    def __init__(self):
+        self.enabled = _env_flag('METRICS_ENABLED', '1')
+        self.server_timing = _env_flag('SERVER_TIMING_ENABLED', '0')
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple[str, Dict, float]]]):
+        """Add a callable returning (name, labels, value) samples at scrape time"""
+        self._collectors.append(collector)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        with self._lock:
+            items = sorted(
+                (name, labels, list(h.counts), h.sum, h.count, h.buckets)
+                for (name, labels), h in self._histograms.items()
+            )
+        lines = []
+        current = None
+        for name, labels, counts, total, count, buckets in items:
+            if name != current:
+                current = name
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+
+        for collector in self._collectors:
+            current = None
+            for name, labels, value in collector():
+                if name != current:
+                    current = name
+                    lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name}{_labels(tuple(sorted(labels.items())))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: Tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics()
+metrics.describe('library_span_seconds', 'Time spent in instrumented code paths')
+metrics.describe('library_sql_seconds', 'SQL statement execution time')
+metrics.describe('library_request_seconds', 'HTTP request handling time')
+
+
+def add_server_timing(name: str, seconds: float):
+    if metrics.server_timing and has_request_context():
+        timings = g.setdefault('server_timing', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+class Span:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name: str, labels: Dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        metrics.observe('library_span_seconds', elapsed, span=self.name, **self.labels)
+        add_server_timing(self.name, elapsed)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(name: str, **labels):
+    """Time a block: `with span('search.load'): ...`"""
+    if not metrics.enabled:
+        return NULL_SPAN
+    return Span(name, labels)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if metrics.enabled:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    metrics.observe('library_sql_seconds', elapsed, operation=operation)
+    add_server_timing('sql', elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    started = connection.info.get('query_started') if connection is not None else None
+    if started:
+        started.pop()
+
+
+def init_app(app):
+    """Time every request, add Server-Timing headers and serve /metrics"""
+
+    @app.before_request
+    def start_request_timer():
+        if metrics.enabled:
+            g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        metrics.observe('library_request_seconds', elapsed, endpoint=request.endpoint or 'unknown',
+                        method=request.method, status=str(response.status_code))
+        if metrics.server_timing:
+            timings: Dict[str, float] = g.pop('server_timing', {})
+            entries: List[str] = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items()]
+            entries.append(f'total;dur={elapsed * 1000:.2f}')
+            response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,40 @@
+"""Bring an existing database up to date with the indexes declared in models.py.
+
+db.create_all() only creates missing tables, so indexes added to a table
+that already exists have to be created separately.
+
+Usage:
+    python migrations.py
+"""
+from models import db
+
+
+def ensure_indexes(log=print):
+    """Create any declared index that is missing; returns the names created"""
+    created = []
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+                if log:
+                    log(f"Created index {index.name} on {table.name}")
+    return created
+
+
+def upgrade():
+    db.create_all()
+    return ensure_indexes()
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        created = upgrade()
+        print(f"Database is up to date ({len(created)} indexes created)")
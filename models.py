@@ -3,6 +3,9 @@ from datetime import datetime
 
 db = SQLAlchemy()
 
+# Fine charged for each full day a loan is overdue
+FINE_PER_DAY = 1.0
+
 class Book(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     book_id = db.Column(db.String(20), unique=True, nullable=False)  # Custom book ID (e.g., LIB-2024-001)
@@ -15,6 +18,14 @@ class Book(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     location = db.Column(db.String(50))  # Physical location in library
     
+    __table_args__ = (
+        db.Index('ix_book_category', 'category'),
+        db.Index('ix_book_author', 'author'),
+        db.Index('ix_book_location', 'location'),
+        # Never reuse the id of a deleted book: in-memory indexes key books by id
+        {'sqlite_autoincrement': True},
+    )
+    
     def __repr__(self):
         return f'<Book {self.book_id}: {self.title}>'
 
@@ -35,6 +46,17 @@ class BorrowRecord(db.Model):
     fine_amount = db.Column(db.Float, default=0.0)  # For late returns
     
     book = db.relationship('Book', backref=db.backref('borrow_records', lazy=True))
+    
+    __table_args__ = (
+        # Active loans of a book (return)
+        db.Index('ix_borrow_record_book_id_returned', 'book_id', 'returned'),
+        # A book's history, paged by record id
+        db.Index('ix_borrow_record_book_id', 'book_id', 'id'),
+        # All open loans across the library
+        db.Index('ix_borrow_record_returned_book_id', 'returned', 'book_id'),
+        # A borrower's loans, and the exact loan closed by a return
+        db.Index('ix_borrow_record_borrower_id', 'borrower_id', 'returned', 'book_id'),
+    )
 
     def __repr__(self):
         return f'<BorrowRecord {self.borrower_name} - {self.book.title}>'
@@ -44,5 +66,79 @@ class BorrowRecord(db.Model):
             return_date = datetime.utcnow()
         if return_date > self.due_date:
             days_late = (return_date - self.due_date).days
-            return max(0, days_late * 1.0)  # $1 per day
+            return max(0, days_late * FINE_PER_DAY)
         return 0.0
+
+class BookIdSequence(db.Model):
+    """Next free number for generated LIB-YYYY-NNNN book ids, one row per year"""
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    next_value = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<BookIdSequence {self.year}: {self.next_value}>'
+
+class CatalogueVersion(db.Model):
+    """Counter bumped whenever books are updated or deleted in place, one row.
+
+    In-memory indexes compare it on sync to notice changes made by a
+    catalogue import or another process; inserts need no bump, as those
+    indexes read new ids through database.IdWatermark.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def current(cls):
+        return db.session.query(cls.version).filter(cls.id == 1).scalar() or 0
+
+    @classmethod
+    def bump(cls):
+        """Increment the version in the caller's transaction"""
+        updated = cls.query.filter(cls.id == 1).update({cls.version: cls.version + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(cls(id=1, version=1))
+
+    def __repr__(self):
+        return f'<CatalogueVersion {self.version}>'
+
+class OverdueLoan(db.Model):
+    """Open loan past its due date, as of the last overdue refresh.
+
+    Rebuilt wholesale by overdue.refresh_overdue(); ids follow due date,
+    so paging by id lists the longest overdue loans first.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    borrow_record_id = db.Column(db.Integer, db.ForeignKey('borrow_record.id'), nullable=False)
+    book_id = db.Column(db.String(20), nullable=False)  # Book.book_id, copied so listing needs no join
+    title = db.Column(db.String(200))
+    borrower_key = db.Column(db.String(100), nullable=False)  # borrower_id, or name when there is none
+    borrower_name = db.Column(db.String(100))
+    borrower_id = db.Column(db.String(50))
+    due_date = db.Column(db.DateTime, nullable=False)
+    days_overdue = db.Column(db.Integer, nullable=False)
+    fine_amount = db.Column(db.Float, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_overdue_loan_borrower_key', 'borrower_key', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<OverdueLoan {self.book_id} - {self.borrower_key}: {self.days_overdue} days>'
+
+class BorrowerFine(db.Model):
+    """Fines accrued on each borrower's overdue loans, as of the last overdue refresh.
+
+    Ids follow the amount owed, largest first.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    borrower_key = db.Column(db.String(100), unique=True, nullable=False)
+    borrower_name = db.Column(db.String(100))
+    borrower_id = db.Column(db.String(50))
+    overdue_loans = db.Column(db.Integer, nullable=False)
+    fine_amount = db.Column(db.Float, nullable=False)
+    oldest_due_date = db.Column(db.DateTime)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<BorrowerFine {self.borrower_key}: {self.fine_amount}>'
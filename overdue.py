@@ -0,0 +1,152 @@
+"""Recompute overdue loans and accrued fines for the whole library.
+
+Every open loan past its due date is written to the overdue_loan table,
+and per-borrower totals to borrower_fine, with a few set-based statements
+in one transaction; /api/overdue and /api/fines page through the result.
+Run it from cron or with --every, or set OVERDUE_SCHEDULER so the app
+refreshes it in the background every OVERDUE_REFRESH_INTERVAL seconds.
+
+Usage:
+    python overdue.py [--every SECONDS]
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime
+
+from database import run_with_retry, whole_days_between
+from models import db, Book, BorrowRecord, BorrowerFine, FINE_PER_DAY, OverdueLoan
+
+OVERDUE_REFRESH_INTERVAL = float(os.getenv('OVERDUE_REFRESH_INTERVAL', 3600))
+# Whether create_app() starts an OverdueScheduler; enable it for one process only
+OVERDUE_SCHEDULER = os.getenv('OVERDUE_SCHEDULER', '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def overdue_loans_select(now):
+    """SELECT of the overdue_loan rows for every open loan due before `now`, longest overdue first"""
+    days_overdue = whole_days_between(BorrowRecord.due_date, db.literal(now, db.DateTime))
+    return db.select(
+        BorrowRecord.id,
+        Book.book_id,
+        Book.title,
+        db.func.coalesce(BorrowRecord.borrower_id, BorrowRecord.borrower_name),
+        BorrowRecord.borrower_name,
+        BorrowRecord.borrower_id,
+        BorrowRecord.due_date,
+        days_overdue,
+        days_overdue * FINE_PER_DAY,
+        db.literal(now, db.DateTime),
+    ).join(Book, Book.id == BorrowRecord.book_id).where(
+        BorrowRecord.returned == False,
+        BorrowRecord.due_date < now
+    ).order_by(BorrowRecord.due_date, BorrowRecord.id)
+
+
+def borrower_fines_select(now):
+    """SELECT of the borrower_fine rows, aggregated from overdue_loan, largest fine first"""
+    total = db.func.sum(OverdueLoan.fine_amount)
+    return db.select(
+        OverdueLoan.borrower_key,
+        db.func.max(OverdueLoan.borrower_name),
+        db.func.max(OverdueLoan.borrower_id),
+        db.func.count(OverdueLoan.id),
+        total,
+        db.func.min(OverdueLoan.due_date),
+        db.literal(now, db.DateTime),
+    ).group_by(OverdueLoan.borrower_key).order_by(total.desc(), OverdueLoan.borrower_key)
+
+
+def refresh_overdue(now=None):
+    """Rebuild overdue_loan and borrower_fine; returns a summary of the run.
+
+    Must be called inside an application context.
+    """
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+
+    def refresh():
+        db.session.execute(OverdueLoan.__table__.delete())
+        db.session.execute(BorrowerFine.__table__.delete())
+        loans = db.session.execute(OverdueLoan.__table__.insert().from_select(
+            ['borrow_record_id', 'book_id', 'title', 'borrower_key', 'borrower_name', 'borrower_id',
+             'due_date', 'days_overdue', 'fine_amount', 'computed_at'],
+            overdue_loans_select(now)
+        )).rowcount
+        borrowers = db.session.execute(BorrowerFine.__table__.insert().from_select(
+            ['borrower_key', 'borrower_name', 'borrower_id', 'overdue_loans', 'fine_amount',
+             'oldest_due_date', 'computed_at'],
+            borrower_fines_select(now)
+        )).rowcount
+        db.session.commit()
+        return loans, borrowers
+
+    loans, borrowers = run_with_retry(refresh)
+    return {
+        'overdue_loans': loans,
+        'borrowers': borrowers,
+        'computed_at': now.isoformat(),
+        'seconds': time.perf_counter() - started,
+    }
+
+
+class OverdueScheduler:
+    """Runs refresh_overdue() in a daemon thread every `interval` seconds"""
+
+    def __init__(self, app, interval: float = OVERDUE_REFRESH_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='overdue-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    result = refresh_overdue()
+                    self.app.logger.info(
+                        f"Overdue refresh: {result['overdue_loans']} loans, "
+                        f"{result['borrowers']} borrowers in {result['seconds']:.2f}s"
+                    )
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f'Error refreshing overdue loans: {str(e)}')
+                finally:
+                    db.session.remove()
+            self._stop.wait(self.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--every', type=float, help='keep running, refreshing every SECONDS')
+    args = parser.parse_args()
+
+    from app import app
+    from migrations import upgrade
+
+    with app.app_context():
+        upgrade()
+        while True:
+            result = refresh_overdue()
+            print(f"{result['overdue_loans']} overdue loans, {result['borrowers']} borrowers "
+                  f"({result['seconds']:.2f}s)")
+            db.session.remove()
+            if not args.every:
+                break
+            time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import json
+import re
+from typing import Dict, Optional, Tuple
+
+CATEGORIES = ['fiction', 'non-fiction', 'programming', 'science', 'history']
+
+INTENTS = ('search', 'borrow', 'return', 'availability')
+
+# Checked in order; the first keyword found decides the intent
+INTENT_KEYWORDS = (
+    ('borrow', 'borrow'),
+    ('return', 'return'),
+    ('available', 'availability'),
+)
+
+QUOTED_TITLE_RE = re.compile(r'"([^"]+)"')
+AUTHOR_RE = re.compile(r'\bby\s+(.+?)\s*[?.!]*$', re.IGNORECASE)
+AVAILABLE_TITLE_RE = re.compile(
+    r'^\s*(?:is|are)\s+(?:the\s+book\s+)?(.+?)\s+(?:currently\s+|still\s+)?available\b',
+    re.IGNORECASE,
+)
+CATEGORY_RES = [
+    (category, re.compile(r'(?<![\w-])' + re.escape(category) + r'(?![\w-])'))
+    for category in CATEGORIES
+]
+
+# Confidence needed before a parse is trusted without asking the model
+CONFIDENCE_THRESHOLD = 0.6
+
+
+def empty_result() -> Dict:
+    return {
+        'intent': 'search',
+        'title': None,
+        'author': None,
+        'category': None,
+        'search_term': None
+    }
+
+
+def detect_intent(query: str) -> str:
+    lowered = query.lower()
+    for keyword, intent in INTENT_KEYWORDS:
+        if keyword in lowered:
+            return intent
+    return 'search'
+
+
+def parse_query(query: str) -> Tuple[Dict, float]:
+    """Extract intent and entities from a query without calling the model.
+
+    Returns the parsed fields and a confidence between 0 and 1.  A query
+    with a quoted title, a "by <author>" clause, a known category or an
+    "is <title> available" question is fully understood locally; anything
+    else falls back to a general search term with low confidence.
+    """
+    query = (query or '').strip()
+    response = empty_result()
+    response['intent'] = detect_intent(query)
+    lowered = query.lower()
+
+    # Look for title in quotes
+    match = QUOTED_TITLE_RE.search(query)
+    if match:
+        response['title'] = match.group(1).strip()
+    elif response['intent'] == 'availability':
+        match = AVAILABLE_TITLE_RE.match(query.strip('?'))
+        if match:
+            response['title'] = match.group(1).strip().strip('"\'')
+
+    # Look for author after "by"
+    match = AUTHOR_RE.search(query)
+    if match:
+        response['author'] = match.group(1).strip()
+
+    # Check for common categories
+    for category, pattern in CATEGORY_RES:
+        if pattern.search(lowered):
+            response['category'] = category
+            break
+
+    if any([response['title'], response['author'], response['category']]):
+        return response, 1.0
+
+    # If no specific fields found, use as general search term
+    response['search_term'] = query or None
+    return response, 0.3
+
+
+def parse_model_output(text: Optional[str], fallback: Dict) -> Dict:
+    """Merge the JSON-like structure returned by the model into `fallback`"""
+    response = dict(fallback)
+    if not text:
+        return response
+
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end <= start:
+        return response
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return response
+    if not isinstance(data, dict):
+        return response
+
+    data = {str(key).lower().replace(' ', '_'): value for key, value in data.items()}
+    intent = str(data.get('intent') or '').lower()
+    if intent in INTENTS:
+        response['intent'] = intent
+    for field, keys in (
+        ('title', ('title', 'book_title')),
+        ('author', ('author', 'author_name')),
+        ('category', ('category',)),
+        ('search_term', ('search_term', 'general_search_term')),
+    ):
+        for key in keys:
+            value = data.get(key)
+            if isinstance(value, str) and value.strip() and value.strip().lower() not in ('none', 'null', 'n/a'):
+                response[field] = value.strip()
+                break
+    return response
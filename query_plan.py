@@ -0,0 +1,165 @@
+"""Audit the query plans of every SQL statement the API issues.
+
+Runs a scripted set of requests against a scratch SQLite database, captures
+each distinct statement through SQLAlchemy's cursor events and prints its
+EXPLAIN QUERY PLAN.  Exits with status 1 if any statement does a full table
+scan that is not listed in ALLOWED_SCANS, so it can run in CI.
+
+Usage:
+    python query_plan.py [-v]
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+from app import app
+from init_db import book_to_row, create_sample_books
+from catalogue_import import import_rows, iter_catalogue
+from database import configure_database
+from migrations import upgrade
+from models import db
+from overdue import refresh_overdue
+from recommendations import recommendations
+
+# Requests exercising each code path; queries are chosen so the local
+# parser answers them and no model call is made
+SCENARIO = [
+    ('POST', '/api/query', {'query': 'programming books'}),
+    ('POST', '/api/query', {'query': 'books by Harper Lee'}),
+    ('POST', '/api/query', {'query': 'return "No Such Book"'}),
+    ('POST', '/api/query/batch', {'queries': ['science books', 'return "No Such Book"'], 'borrower_id': 'S-1'}),
+    ('GET', '/api/books', None),
+    ('GET', '/api/books?limit=2&cursor=1', None),
+    ('GET', '/api/books?category=Fiction&limit=2', None),
+    ('GET', '/api/books?location=Shelf%20A1&available=true', None),
+    ('POST', '/api/books/PRG001/borrow', {'borrower_name': 'Plan Check', 'borrower_id': 'S-1'}),
+    ('POST', '/api/books/PRG001/return', {'condition': 'Good'}),
+    ('POST', '/api/books/PRG001/borrow', {'borrower_name': 'Plan Check', 'borrower_id': 'S-1'}),
+    ('POST', '/api/books/PRG001/return', {'condition': 'Good', 'borrower_id': 'S-1'}),
+    ('POST', '/api/books/PRG002/borrow', {'borrower_name': 'Plan Check', 'borrower_id': 'S-1'}),
+    ('GET', '/api/borrowers/S-1/loans', None),
+    ('GET', '/api/borrowers/S-1/loans?status=all&limit=10&cursor=0', None),
+    ('GET', '/api/borrowers/S-1/loans?status=returned&limit=10', None),
+    ('GET', '/api/books/PRG001/history', None),
+    ('GET', '/api/books/PRG001/history?limit=10&cursor=0&from=2020-01-01&to=2030-12-31', None),
+    ('GET', '/api/books/PRG001/history?summary=true', None),
+    ('POST', '/api/books', {'title': 'Plan Check', 'author': 'Nobody', 'quantity': 1}),
+    ('POST', '/api/books', {'title': 'Plan Check 2', 'author': 'Nobody', 'quantity': 1}),
+    ('POST', '/api/books/batch', {'books': [{'title': 'Batch', 'author': 'Nobody', 'quantity': 2}]}),
+    ('GET', '/api/overdue', None),
+    ('GET', '/api/overdue?borrower_id=S-1&limit=10&cursor=0', None),
+    ('GET', '/api/fines?limit=10&cursor=0', None),
+    ('GET', '/api/books/PRG001/similar', None),
+    ('GET', '/api/borrowers/S-1/recommendations?limit=5', None),
+]
+
+
+def sync_and_export():
+    """Catalogue sync that updates, withdraws and deletes books, then an export"""
+    rows = [book_to_row(book) for book in create_sample_books()]
+    rows[1]['title'] += ' (2nd edition)'
+    # PRG001 has loans by now and is withdrawn; books added by the scenario are deleted
+    import_rows(rows[1:], log=None, delete_missing=True)
+    for _ in iter_catalogue():
+        pass
+
+
+# Background jobs run after the requests, in the same capture
+JOBS = [refresh_overdue, sync_and_export]
+
+# Substrings of statements that are allowed to scan a whole table
+ALLOWED_SCANS = []
+
+FULL_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(?!CONSTANT ROW)\S+(?: AS \S+)?$')
+
+
+def capture_statements(fn):
+    """Run fn() and return the distinct (statement, parameters) pairs it executed"""
+    statements = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+            statements.setdefault(statement, parameters)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return list(statements.items())
+
+
+def explain(statement, parameters):
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def full_scans(plan):
+    return [line for line in plan if FULL_SCAN_RE.match(line.strip())]
+
+
+def run_scenario():
+    # Built up front as at warm-up; requests only sync it
+    recommendations.rebuild()
+    client = app.test_client()
+    for method, url, body in SCENARIO:
+        response = client.open(url, method=method, json=body)
+        response.get_data()
+        if response.status_code >= 500:
+            raise RuntimeError(f'{method} {url} failed: {response.get_data(as_text=True)}')
+    for job in JOBS:
+        job()
+
+
+def audit(verbose=False):
+    """Print query plans and return the statements that scan a full table"""
+    with app.app_context():
+        upgrade()
+        import_rows([book_to_row(book) for book in create_sample_books()], log=None)
+        statements = capture_statements(run_scenario)
+
+        problems = []
+        for statement, parameters in statements:
+            plan = explain(statement, parameters)
+            scans = full_scans(plan)
+            allowed = any(pattern in statement for pattern in ALLOWED_SCANS)
+            if scans and not allowed:
+                problems.append((statement, plan))
+            if verbose or (scans and not allowed):
+                print(('FULL SCAN' if scans and not allowed else 'ok') + ': ' + ' '.join(statement.split()))
+                for line in plan:
+                    print(f'    {line}')
+        print(f'{len(statements)} statements checked, {len(problems)} full table scans')
+        db.session.remove()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every plan, not just scans')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    configure_database(app, f'sqlite:///{path}')
+    try:
+        problems = audit(args.verbose)
+    finally:
+        os.remove(path)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""Book recommendations from co-borrowing.
+
+Two books are similar when the same borrowers (by borrower_id) borrowed
+both: the score is the cosine similarity of their sets of borrowers,
+co_borrowers / sqrt(borrowers_a * borrowers_b).  rebuild() computes it
+for the whole history as a sparse matrix product with SciPy and keeps the
+top RECOMMENDATION_NEIGHBOURS neighbours of every book in memory.
+Between rebuilds, sync() reads only borrow records it has not seen yet
+(database.IdWatermark, as search_index does for books) and updates the
+books they touch;
+a full rebuild in a background thread every
+RECOMMENDATION_REBUILD_INTERVAL seconds renormalises the rest.
+"""
+import os
+import threading
+import time
+from collections import Counter
+from math import sqrt
+from typing import Dict, List, Optional, Tuple
+
+from flask import current_app
+
+from database import IdWatermark
+from models import db, BorrowRecord
+from serialization import iter_rows_by_id
+
+RECOMMENDATION_NEIGHBOURS = int(os.getenv('RECOMMENDATION_NEIGHBOURS', 20))
+RECOMMENDATION_REBUILD_INTERVAL = float(os.getenv('RECOMMENDATION_REBUILD_INTERVAL', 3600))
+
+# Borrow records read per query while rebuilding
+REBUILD_BATCH_SIZE = 10000
+
+
+class CoBorrowIndex:
+    """Top-k co-borrowed neighbours of each book, keyed by book primary key.
+
+    Alongside the neighbours it keeps who borrowed what in both directions,
+    which is all sync() needs to rescore a book without the database.  A
+    new borrow re-ranks the borrowed book and offers it as a neighbour to
+    the other books its borrower has read; the remaining scores involving
+    that book are refreshed by the next rebuild.
+    """
+
+    def __init__(self, neighbours: int = RECOMMENDATION_NEIGHBOURS,
+                 rebuild_interval: float = RECOMMENDATION_REBUILD_INTERVAL):
+        self.neighbours = neighbours
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.RLock()
+        self._rebuilding = False
+        self._watermark = IdWatermark()
+        self._borrowers = {}    # borrower_id -> set of book pks
+        self._readers = {}      # book pk -> set of borrower_ids
+        self._neighbours = {}   # book pk -> ((book pk, score), ...)
+        self._built_at = None
+
+    def __len__(self):
+        return len(self._neighbours)
+
+    def _build(self, last_id: int, watermark: IdWatermark) -> Tuple[Dict, Dict, Dict]:
+        """Borrowers, readers and neighbours from borrow records up to `last_id`"""
+        # Only needed here, and slow to import
+        import numpy as np
+        from scipy import sparse
+
+        borrowers, readers = {}, {}
+        recent = []
+        query = db.session.query(BorrowRecord.id, BorrowRecord.borrower_id, BorrowRecord.book_id).filter(
+            BorrowRecord.id <= last_id
+        )
+        for record_id, borrower_id, book_pk in iter_rows_by_id(query, BorrowRecord.id,
+                                                               batch_size=REBUILD_BATCH_SIZE):
+            # Only the most recent ids can still be missing for want of a commit
+            if record_id > last_id - watermark.max_gaps:
+                recent.append(record_id)
+            if borrower_id:
+                borrowers.setdefault(borrower_id, set()).add(book_pk)
+                readers.setdefault(book_pk, set()).add(borrower_id)
+
+        # Borrowers x books incidence matrix; its Gram matrix counts co-borrowers
+        book_pks = list(readers)
+        positions = {book_pk: column for column, book_pk in enumerate(book_pks)}
+        rows = [row for row, books in enumerate(borrowers.values()) for _ in books]
+        columns = [positions[book_pk] for books in borrowers.values() for book_pk in books]
+        incidence = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+                                      shape=(len(borrowers), len(book_pks)))
+        co_borrows = (incidence.T @ incidence).tocsr()
+        counts = co_borrows.diagonal()
+        co_borrows.setdiag(0)
+        co_borrows.eliminate_zeros()
+
+        # Cosine similarity: scale rows and columns by 1/sqrt(borrowers)
+        scale = sparse.diags(1 / np.sqrt(np.maximum(counts, 1)))
+        similarity = (scale @ co_borrows @ scale).tocsr()
+        neighbours = {}
+        k = self.neighbours
+        for row, book_pk in enumerate(book_pks):
+            start, end = similarity.indptr[row], similarity.indptr[row + 1]
+            if start == end:
+                continue
+            scores = similarity.data[start:end]
+            others = similarity.indices[start:end]
+            top = np.argpartition(-scores, k - 1)[:k] if end - start > k else np.arange(end - start)
+            top = top[np.lexsort((others[top], -scores[top]))]
+            neighbours[book_pk] = tuple((book_pks[others[i]], float(scores[i])) for i in top)
+        watermark.advance(recent)
+        return borrowers, readers, neighbours
+
+    def rebuild(self) -> int:
+        """Recompute every book's neighbours from the whole borrow history.
+
+        Must be called inside an application context; returns the number of
+        books with neighbours.
+        """
+        last_id = db.session.query(db.func.max(BorrowRecord.id)).scalar() or 0
+        watermark = IdWatermark()
+        borrowers, readers, neighbours = self._build(last_id, watermark)
+        with self._lock:
+            self._watermark = watermark
+            self._borrowers, self._readers, self._neighbours = borrowers, readers, neighbours
+            self._built_at = time.monotonic()
+            self._sync()
+            return len(self._neighbours)
+
+    def _rebuild_in_background(self, app):
+        with app.app_context():
+            try:
+                self.rebuild()
+            except Exception as e:
+                app.logger.error(f'Error rebuilding recommendations: {str(e)}')
+            finally:
+                self._rebuilding = False
+                db.session.remove()
+
+    def _start_rebuild(self):
+        """Rebuild in a background thread unless one is running; call with the lock held"""
+        if not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, args=(current_app._get_current_object(),),
+                             name='recommendations-rebuild', daemon=True).start()
+
+    def sync(self) -> int:
+        """Apply borrow records added since the last sync or rebuild.
+
+        Requests never build the index themselves: until rebuild() has run
+        (at warm-up, say) the first call starts it in a background thread
+        and the index stays empty meanwhile, and a stale index is rebuilt
+        the same way while this one keeps serving.  Must be called inside
+        an application context; returns the number of records read.
+        """
+        with self._lock:
+            if self._built_at is None:
+                self._start_rebuild()
+                return 0
+            if self.rebuild_interval > 0 and time.monotonic() - self._built_at > self.rebuild_interval:
+                self._start_rebuild()
+            return self._sync()
+
+    def _sync(self) -> int:
+        rows = self._watermark.read(
+            db.session.query(BorrowRecord.id, BorrowRecord.borrower_id, BorrowRecord.book_id), BorrowRecord.id
+        )
+        borrowed, offers = set(), {}
+        for _, borrower_id, book_pk in rows:
+            if not borrower_id:
+                continue
+            books = self._borrowers.setdefault(borrower_id, set())
+            if book_pk in books:
+                continue
+            for other in books:
+                offers.setdefault(other, set()).add(book_pk)
+            books.add(book_pk)
+            self._readers.setdefault(book_pk, set()).add(borrower_id)
+            borrowed.add(book_pk)
+        for book_pk in borrowed:
+            self._neighbours[book_pk] = self._rank(book_pk)
+        for book_pk, candidates in offers.items():
+            if book_pk not in borrowed:
+                self._neighbours[book_pk] = self._offer(book_pk, candidates)
+        return len(rows)
+
+    def _score(self, book_pk: int, other: int, co_borrowers: int) -> float:
+        return co_borrowers / sqrt(len(self._readers[book_pk]) * len(self._readers[other]))
+
+    def _top(self, scores) -> Tuple:
+        ranked = sorted(scores, key=lambda item: (-item[1], item[0]))
+        return tuple(ranked[:self.neighbours])
+
+    def _rank(self, book_pk: int) -> Tuple:
+        """Top neighbours of one book, counted from its borrowers' other books"""
+        counts = Counter()
+        for borrower_id in self._readers[book_pk]:
+            counts.update(self._borrowers[borrower_id])
+        del counts[book_pk]
+        return self._top((other, self._score(book_pk, other, count)) for other, count in counts.items())
+
+    def _offer(self, book_pk: int, candidates) -> Tuple:
+        """A book's neighbours with `candidates` rescored, without re-ranking the rest"""
+        scores = dict(self._neighbours.get(book_pk, ()))
+        readers = self._readers[book_pk]
+        for other in candidates:
+            scores[other] = self._score(book_pk, other, len(readers & self._readers[other]))
+        return self._top(scores.items())
+
+    def similar(self, book_pk: int, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """(book pk, score) of the books most often borrowed with this one, best first"""
+        return list(self._neighbours.get(book_pk, ())[:limit or self.neighbours])
+
+    def recommend(self, borrower_id: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """(book pk, score) of books similar to a borrower's, excluding ones they have read"""
+        with self._lock:
+            books = set(self._borrowers.get(borrower_id, ()))
+            scores = Counter()
+            for book_pk in books:
+                for other, score in self._neighbours.get(book_pk, ()):
+                    if other not in books:
+                        scores[other] += score
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'books': len(self._neighbours),
+                'borrowers': len(self._borrowers),
+                'last_record_id': self._watermark.last_id,
+                'pending_record_ids': len(self._watermark),
+                'age_seconds': time.monotonic() - self._built_at if self._built_at is not None else None,
+                'rebuilding': self._rebuilding,
+            }
+
+
+recommendations = CoBorrowIndex()
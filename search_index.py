@@ -0,0 +1,319 @@
+import heapq
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+from database import IdWatermark
+from instrumentation import span
+from models import db, Book, CatalogueVersion
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+FIELDS = ('title', 'author', 'category')
+
+# Order in which search_books tries the query parameters, and the fields
+# each stage is matched against.
+CASCADE = (
+    ('title', ('title',)),
+    ('category', ('category',)),
+    ('author', ('author',)),
+    ('search_term', FIELDS),
+)
+
+# Typo-tolerant stages tried when the exact cascade finds nothing
+FUZZY_FIELDS = ('title', 'author')
+FUZZY_CASCADE = (
+    ('title', ('title',)),
+    ('author', ('author',)),
+    ('search_term', FUZZY_FIELDS),
+)
+
+# Minimum trigram similarity for a word to count as a misspelling of
+# another, and how many similar words each query word may expand to
+FUZZY_THRESHOLD = 0.3
+FUZZY_MAX_CANDIDATES = 20
+
+# Query words too short or too common to be read as a misspelt title or
+# author word: shorter words prefix-match almost anything, and the rest
+# are how people ask for a book rather than which book they want
+FUZZY_MIN_LENGTH = 3
+FUZZY_STOP_WORDS = frozenset('''
+    about all and any anything are available book books borrow can check copies copy could
+    did does find for from get give got has have how library like look looking need not novel
+    novels one out please read reading return returning show some something stories story
+    tell that the there these this those title titles want was what when where which who will
+    with would you your
+'''.split())
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Split text into lowercase word tokens"""
+    if not text:
+        return []
+    return TOKEN_RE.findall(str(text).lower())
+
+
+def trigrams(token: str) -> Set[str]:
+    """Padded character trigrams, so word starts and ends weigh in"""
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """In-memory inverted index over Book title, author and category.
+
+    Every query token has to match the start of some token in the field
+    (so "gats" finds "The Great Gatsby"), and results are ranked by how many
+    tokens matched exactly.  The index only stores primary keys; rows are
+    loaded from the database by id, so availability is never stale.
+
+    Title and author words are also indexed by trigram, so fuzzy_search
+    can match misspellings ("gatsbey", "hawkins") against words that share
+    enough trigrams, without comparing the query to the whole vocabulary.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {field: defaultdict(set) for field in FIELDS}
+        self._vocab = {field: [] for field in FIELDS}
+        self._trigrams = {field: defaultdict(set) for field in FUZZY_FIELDS}
+        self._trigram_counts = {field: {} for field in FUZZY_FIELDS}
+        self._dirty = set()
+        self._docs = {}
+        self._watermark = IdWatermark()
+        self._version = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    def clear(self):
+        with self._lock:
+            for field in FIELDS:
+                self._postings[field].clear()
+                self._vocab[field] = []
+            for field in FUZZY_FIELDS:
+                self._trigrams[field].clear()
+                self._trigram_counts[field].clear()
+            self._dirty.clear()
+            self._docs.clear()
+            self._watermark = IdWatermark()
+            self._version = None
+
+    def add(self, book_id: int, title=None, author=None, category=None):
+        """Index (or re-index) a single book by primary key"""
+        with self._lock:
+            if book_id in self._docs:
+                self.remove(book_id)
+            tokens = {
+                'title': set(tokenize(title)),
+                'author': set(tokenize(author)),
+                'category': set(tokenize(category)),
+            }
+            for field, field_tokens in tokens.items():
+                postings = self._postings[field]
+                for token in field_tokens:
+                    if token not in postings:
+                        self._dirty.add(field)
+                        self._add_trigrams(field, token)
+                    postings[token].add(book_id)
+            self._docs[book_id] = tokens
+
+    def remove(self, book_id: int):
+        with self._lock:
+            tokens = self._docs.pop(book_id, None)
+            if not tokens:
+                return
+            for field, field_tokens in tokens.items():
+                postings = self._postings[field]
+                for token in field_tokens:
+                    ids = postings.get(token)
+                    if ids is None:
+                        continue
+                    ids.discard(book_id)
+                    if not ids:
+                        del postings[token]
+                        self._dirty.add(field)
+                        self._remove_trigrams(field, token)
+
+    def _add_trigrams(self, field: str, token: str):
+        if field in self._trigrams:
+            grams = trigrams(token)
+            for gram in grams:
+                self._trigrams[field][gram].add(token)
+            self._trigram_counts[field][token] = len(grams)
+
+    def _remove_trigrams(self, field: str, token: str):
+        if field in self._trigrams:
+            for gram in trigrams(token):
+                tokens = self._trigrams[field].get(gram)
+                if tokens is not None:
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._trigrams[field][gram]
+            self._trigram_counts[field].pop(token, None)
+
+    def sync(self):
+        """Pick up books inserted since the last sync.
+
+        Only rows with an id above the highest indexed id (or a missing one
+        just below it, see IdWatermark) are read, which is a range scan on
+        the primary key and returns nothing in the common case.
+        When the catalogue version shows that books were updated or deleted
+        in place (by a catalogue import, possibly in another process) the
+        whole index is reloaded instead.  Must be called inside an
+        application context.
+        """
+        with self._lock:
+            version = CatalogueVersion.current()
+            if version != self._version:
+                self.clear()
+                self._version = version
+            rows = self._watermark.read(
+                db.session.query(Book.id, Book.title, Book.author, Book.category), Book.id
+            )
+            for row in rows:
+                self.add(row.id, row.title, row.author, row.category)
+            return len(rows)
+
+    def rebuild(self):
+        with self._lock:
+            self.clear()
+            return self.sync()
+
+    def _vocabulary(self, field: str) -> List[str]:
+        if field in self._dirty:
+            self._vocab[field] = sorted(self._postings[field])
+            self._dirty.discard(field)
+        return self._vocab[field]
+
+    def _match_token(self, field: str, token: str) -> Dict[int, int]:
+        """Return {book id: score} for books whose field has a token starting with `token`"""
+        vocab = self._vocabulary(field)
+        postings = self._postings[field]
+        scores = {}
+        start = bisect_left(vocab, token)
+        for candidate in vocab[start:]:
+            if not candidate.startswith(token):
+                break
+            weight = 2 if candidate == token else 1
+            for book_id in postings[candidate]:
+                if scores.get(book_id, 0) < weight:
+                    scores[book_id] = weight
+        return scores
+
+    def _fuzzy_token(self, field: str, token: str) -> Dict[int, float]:
+        """Return {book id: similarity} for books whose field has a word like `token`.
+
+        Similarity is the Jaccard index of the two words' trigram sets; words
+        that `token` is a prefix of count as exact matches.
+        """
+        grams = trigrams(token)
+        index = self._trigrams[field]
+        shared = Counter()
+        for gram in grams:
+            shared.update(index.get(gram, ()))
+        counts = self._trigram_counts[field]
+        similar = []
+        for candidate, common in shared.items():
+            if candidate.startswith(token):
+                similarity = 1.0
+            else:
+                similarity = common / (len(grams) + counts[candidate] - common)
+            if similarity >= FUZZY_THRESHOLD:
+                similar.append((similarity, candidate))
+
+        postings = self._postings[field]
+        scores = {}
+        for similarity, candidate in heapq.nlargest(FUZZY_MAX_CANDIDATES, similar):
+            for book_id in postings[candidate]:
+                if scores.get(book_id, 0) < similarity:
+                    scores[book_id] = similarity
+        return scores
+
+    def _search_field(self, field: str, tokens: List[str], match=None) -> Dict[int, float]:
+        match = match or self._match_token
+        scores = None
+        # Intersect the rarest tokens first to keep candidate sets small
+        for token in sorted(set(tokens), key=len, reverse=True):
+            matches = match(field, token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {
+                    book_id: score + matches[book_id]
+                    for book_id, score in scores.items()
+                    if book_id in matches
+                }
+            if not scores:
+                return {}
+        return scores or {}
+
+    def search(self, text: str, fields: Iterable[str] = FIELDS) -> List[int]:
+        """Return ids of books matching all tokens of `text` in any of `fields`, best first"""
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        with self._lock:
+            combined = {}
+            for field in fields:
+                for book_id, score in self._search_field(field, tokens).items():
+                    if combined.get(book_id, 0) < score:
+                        combined[book_id] = score
+        return sorted(combined, key=lambda book_id: (-combined[book_id], book_id))
+
+    def fuzzy_search(self, text: str, fields: Iterable[str] = FUZZY_FIELDS) -> List[int]:
+        """Like search(), but each word may also match similar words in title or author.
+
+        Short and common words ("to", "find", "book") are left out.  More
+        than half of the remaining words must have something similar in
+        one of `fields`, or nothing matches; those that do not are ignored
+        and every other word has to match.  Results are ranked by total
+        similarity.
+        """
+        fields = [field for field in fields if field in FUZZY_FIELDS]
+        words = {token for token in tokenize(text)
+                 if len(token) >= FUZZY_MIN_LENGTH and token not in FUZZY_STOP_WORDS}
+        if not words:
+            return []
+        with self._lock:
+            matches = {field: {token: self._fuzzy_token(field, token) for token in words}
+                       for field in fields}
+            tokens = [token for token in words if any(matches[field][token] for field in fields)]
+            if len(tokens) * 2 <= len(words):
+                return []
+            combined = {}
+            for field in fields:
+                scores = self._search_field(field, tokens, lambda field, token: matches[field][token])
+                for book_id, score in scores.items():
+                    if combined.get(book_id, 0) < score:
+                        combined[book_id] = score
+        return sorted(combined, key=lambda book_id: (-combined[book_id], book_id))
+
+    def lookup(self, query_params: Dict, fuzzy: bool = True) -> List[int]:
+        """Run the title -> category -> author -> search term cascade, then
+        (unless fuzzy=False) the same with typo tolerance if nothing matched
+        exactly"""
+        for key, fields in CASCADE:
+            text = query_params.get(key)
+            if not text:
+                continue
+            with span('search.stage', stage=key):
+                book_ids = self.search(text, fields)
+            if book_ids:
+                return book_ids
+        if not fuzzy:
+            return []
+        for key, fields in FUZZY_CASCADE:
+            text = query_params.get(key)
+            if not text:
+                continue
+            with span('search.stage', stage=f'fuzzy_{key}'):
+                book_ids = self.fuzzy_search(text, fields)
+            if book_ids:
+                return book_ids
+        return []
+
+
+search_index = SearchIndex()
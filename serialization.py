@@ -0,0 +1,147 @@
+"""JSON responses built from lightweight rows.
+
+Endpoints select only the columns they return, as row tuples (or
+CachedBook rows), and turn them into dicts with a serializer built once
+per field list.  Encoding uses orjson when it is installed and the
+standard library otherwise.  Complete GET responses carry an ETag and
+answer a matching If-None-Match with 304; responses above GZIP_MIN_SIZE
+are gzipped for clients that accept it, streamed ones chunk by chunk.
+"""
+import gzip
+import hashlib
+import json
+import os
+import zlib
+from datetime import date
+from decimal import Decimal
+from operator import attrgetter, itemgetter
+from typing import Callable, Iterable, Iterator, Sequence
+
+from flask import Response, request, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STREAM_BATCH_SIZE = 500
+
+# Smaller bodies are not worth compressing
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(value) -> bytes:
+    """Encode `value` as compact JSON; dates and datetimes become ISO 8601 strings"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_default)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=_default).encode()
+
+
+def record_serializer(fields: Sequence[str]) -> Callable:
+    """to_dict for objects that have `fields` as attributes (ORM or CachedBook rows)"""
+    fields = tuple(fields)
+    if len(fields) == 1:
+        return lambda record: {fields[0]: getattr(record, fields[0])}
+    get = attrgetter(*fields)
+    return lambda record: dict(zip(fields, get(record)))
+
+
+def row_serializer(fields: Sequence[str], offset: int = 1) -> Callable:
+    """to_dict for row tuples holding `fields` after `offset` leading columns (usually the id)"""
+    fields = tuple(fields)
+    if len(fields) == 1:
+        return lambda row: {fields[0]: row[offset]}
+    get = itemgetter(*range(offset, offset + len(fields)))
+    return lambda row: dict(zip(fields, get(row)))
+
+
+def accepts_gzip() -> bool:
+    return 'gzip' in request.accept_encodings
+
+
+def finish_response(response: Response, body: bytes) -> Response:
+    """Add an ETag (answering If-None-Match with 304) and gzip large bodies"""
+    if request.method in ('GET', 'HEAD') and response.status_code == 200:
+        # Weak, as the gzipped and plain representations share it
+        response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest(), weak=True)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    response.vary.add('Accept-Encoding')
+    if len(body) >= GZIP_MIN_SIZE and accepts_gzip():
+        response.set_data(gzip.compress(body, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def json_response(value, status: int = 200, headers=None) -> Response:
+    body = dumps(value)
+    response = Response(body, status=status, headers=headers, mimetype='application/json')
+    return finish_response(response, body)
+
+
+def iter_rows_by_id(query, id_column, after_id=0, batch_size=STREAM_BATCH_SIZE) -> Iterator:
+    """Yield rows of a query whose first column is `id_column` in keyset-paginated batches"""
+    while True:
+        rows = query.filter(id_column > after_id).order_by(id_column).limit(batch_size).all()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1][0]
+
+
+def stream_json_array(rows: Iterable, to_dict: Callable, batch_size=STREAM_BATCH_SIZE) -> Iterator[bytes]:
+    """Encode rows as a JSON array in chunks so memory stays flat"""
+    yield b'['
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(to_dict(row))
+        if len(chunk) >= batch_size:
+            yield (b'' if first else b',') + dumps(chunk)[1:-1]
+            first = False
+            chunk = []
+    if chunk:
+        yield (b'' if first else b',') + dumps(chunk)[1:-1]
+    yield b']'
+
+
+def gzip_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Gzip a stream, flushing after each chunk so the client gets data as it is produced"""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def paginated_json_response(query, id_column, to_dict, limit=None, cursor=0) -> Response:
+    """Respond with one keyset page of `query`, or stream every row when no limit is given.
+
+    The first column of `query` must be `id_column`; the id to resume from
+    is sent in the X-Next-Cursor header.
+    """
+    if limit is None:
+        chunks = stream_json_array(iter_rows_by_id(query, id_column, after_id=cursor), to_dict)
+        response = Response(mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        if accepts_gzip():
+            chunks = gzip_stream(chunks)
+            response.headers['Content-Encoding'] = 'gzip'
+        response.response = stream_with_context(chunks)
+        return response
+
+    rows = query.filter(id_column > cursor).order_by(id_column).limit(limit + 1).all()
+    body = dumps([to_dict(row) for row in rows[:limit]])
+    response = Response(body, mimetype='application/json')
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = str(rows[limit - 1][0])
+    return finish_response(response, body)